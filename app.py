@@ -2,14 +2,24 @@ import os
 import json
 import logging
 import flask
+import numpy
+import time
 import typer
+import threading
+import concurrent.futures
 from sys import exit
 from io import BytesIO
 from datetime import datetime
-from subprocess import call
-from PIL import Image, ImageStat
+from PIL import Image, ImageStat, JpegImagePlugin
 from v4l2py import Device
+from v4l2py import raw
+from v4l2py import jpeg
+from v4l2py.device import EventType, Mode, ModeSwitcher
+from v4l2py.worker import CaptureWorker, parse_cpus
 from mdns import init_service
+from storage import Retention, Writer
+from capture_index import METRICS, CaptureIndex
+from exposure import CalibrationTable, ModelController, StepController, WarmStart
 
 app = flask.Flask(__name__)
 log = logging.getLogger(__name__)
@@ -24,6 +34,10 @@ g_xoffset = 408
 g_yoffset = 0
 g_path = "/tmp"
 g_device = 0
+# Seconds to wait for the camera to come back after a USB reset
+g_recover_timeout = 10.0
+g_enable_hardware_crop = True
+g_hardware_crop = False
 
 g_enable_single_color_rejection = True
 g_enable_brightness_optimisation = True
@@ -37,6 +51,17 @@ g_exposure_absolute = 300
 g_exposure_absolute_min = 25
 g_exposure_absolute_max = 1000
 g_exposure_absolute_step = 25
+# "model": secant steps on the brightness model, "step": fixed steps
+g_exposure_controller = "model"
+g_controller = None
+# Exposures sampled to calibrate and where the table is kept across restarts
+g_calibration_points = 6
+g_calibration_file = ""
+g_recalibrate = False
+# Start searches from recent converged results (kept across restarts)
+g_warm_start = True
+g_warm_start_file = ""
+g_warm_starts = None
 brightness_slope = 1
 brightness_intercept = 0
 best_brightness_diff = 1E10
@@ -54,6 +79,66 @@ g_contrast_control_step = 2
 
 g_max_attempts = 50
 
+# Meter on the Y plane of small YUYV frames instead of full-res MJPEG
+g_meter_yuyv = False
+g_meter_width = 640
+g_meter_height = 480
+g_meter_step = 2
+# Decode MJPEG frames at 1/2, 1/4 or 1/8 of their size to meter them (1: full)
+g_meter_scale = 1
+g_switcher = None
+# Moving averages used to decide whether switching to the metering mode pays off
+g_iteration_time = {}
+# Capture thread: CPUs to pin it to ("2,3"), SCHED_FIFO priority and nice
+g_capture_cpus = ""
+g_capture_priority = 0
+g_capture_nice = 0
+g_worker = None
+
+# Keep the exposure converged in the background, POST / then only waits for
+# a frame within the tolerances (up to g_track_timeout seconds)
+g_track = False
+g_track_interval = 2.0
+g_track_timeout = 5.0
+g_tracker = {"state": "off", "converged": False, "iterations": 0}
+g_tracker_stop = threading.Event()
+# Held while using the camera and its controls
+g_camera_lock = threading.RLock()
+# (exposure, contrast control) last sent to the camera
+g_applied_controls = None
+# Set when reading a frame failed (eg. the camera didn't come back): the
+# frame iterator is finished and is replaced before the next capture
+g_stream_failed = False
+
+# Choose the controls from 1/8 scale estimates while the frames are analysed
+# in the background. Difference between the analyses and the estimates
+g_pipeline = False
+g_analysis = None
+g_estimate_bias = {"brightness": 0, "contrast": 0}
+
+# Upper bound of frames captured before a control change we throw away
+g_max_stale_frames = 4
+g_mean_attempts = None
+
+# Background writer of the images: queue length and fsync policy
+g_storage_queue = 8
+g_storage_fsync = "file"
+g_writer = None
+# Limits of the images kept in g_path (0: no limit)
+g_retention_max_mb = 0
+g_retention_max_days = 0
+g_retention_max_count = 0
+g_retention = None
+# SQLite index of the captures (default: captures.db in g_path)
+g_index_path = ""
+g_index = None
+# Store the exposure, contrast and metrics in the EXIF of the images
+g_embed_metadata = True
+
+# JPEG quality used while searching for the right exposure (0 disables)
+g_metering_quality = 0
+g_still_quality = None
+
 
 def success(result):
     payload = {"ok": True, **result}
@@ -85,116 +170,628 @@ def estimate_contrast(img):
     return stat.stddev[0]
 
 
+def analyse(img):
+    """Brightness (rms) and contrast (stddev) of the luma from a single
+    conversion and histogram. Hue is only computed if it is optimised"""
+    im = img if img.mode == 'L' else img.convert('L')
+    stat = ImageStat.Stat(im)
+    return {
+        "brightness": stat.rms[0],
+        "contrast": stat.stddev[0],
+        "hue": estimate_hue(img) if g_enable_hue_optimisation else None,
+    }
+
+
+def decode(image_bytes, scale=None):
+    """Decode a frame for metering, scaled down by scale (g_meter_scale by
+    default) straight from the DCT, and crop it to the region we keep.
+
+    At 1/8 libjpeg only uses the DC coefficient of each block: the pixels are
+    the 8x8 block means, so the contrast comes out a bit lower"""
+    if scale is None:
+        scale = g_meter_scale
+    image = Image.open(image_bytes)
+    width, height = image.size
+    if g_enable_hue_optimisation:
+        # Hue needs colour
+        if scale > 1:
+            image.draft('RGB', (width // scale, height // scale))
+    else:
+        # Only decode the Y component, even at full scale it saves the colour
+        # conversion and gives the same luma statistics
+        image.draft('L', (width // scale, height // scale))
+    image.load()
+    if not g_hardware_crop:
+        xoffset = g_xoffset * image.size[0] // width
+        yoffset = g_yoffset * image.size[1] // height
+        image = image.crop((xoffset, yoffset, image.size[0] -
+                            xoffset, image.size[1] - yoffset))
+    return image
+
+
+def crop_frame(image_bytes):
+    """The JPEG of the region we keep of a frame, cropped losslessly if the
+    offsets are aligned to the JPEG MCUs, otherwise decoded and re-encoded"""
+    box = (g_xoffset, g_yoffset, g_width - g_xoffset, g_height - g_yoffset)
+    try:
+        return jpeg.crop(image_bytes.getbuffer(), g_xoffset, g_yoffset,
+                         box[2] - box[0], box[3] - box[1])
+    except jpeg.JpegError as e:
+        log.debug(f"Lossless crop not possible: {e}")
+    image = Image.open(image_bytes)
+    cropped = BytesIO()
+    # Re-encode with the camera's tables to keep its quality
+    image.crop(box).save(
+        cropped, "JPEG", qtables=image.quantization,
+        subsampling=JpegImagePlugin.get_sampling(image))
+    return cropped.getvalue()
+
+
+def report_crop(frame):
+    """Say once which way the captures will be cropped"""
+    if g_hardware_crop:
+        message = "Cropping in the camera"
+    elif jpeg.turbojpeg() is None:
+        message = "libturbojpeg not found, crops are decoded and re-encoded"
+    else:
+        header = jpeg.parse_header(frame)
+        if g_xoffset % header.mcu_width or g_yoffset % header.mcu_height:
+            message = (f"Crop offsets {g_xoffset},{g_yoffset} not aligned to the "
+                       f"{header.mcu_width}x{header.mcu_height} MCU, crops are "
+                       "decoded and re-encoded")
+        else:
+            message = "Cropping losslessly"
+    print(message)
+    log.info(message)
+
+
+def calibration_settings():
+    """What a calibration table depends on"""
+    return {
+        "exposure_min": g_exposure_absolute_min,
+        "exposure_max": g_exposure_absolute_max,
+        "points": g_calibration_points,
+        "contrast_control": g_contrast_control,
+        "crop": [g_xoffset, g_yoffset, g_hardware_crop],
+    }
+
+
+def calibrate():
+    """Measure the brightness at g_calibration_points exposures"""
+    global g_exposure_absolute
+    points = []
+    exposures = CalibrationTable.exposures_between(
+        g_exposure_absolute_min, g_exposure_absolute_max, g_calibration_points)
+    for exposure in exposures:
+        g_exposure_absolute = exposure
+        points.append((exposure, capture_and_calculate()['brightness']))
+        print(f"Calibration: exposure {exposure} brightness {points[-1][1]:.1f}")
+    return CalibrationTable(points, calibration_settings())
+
+
 def calc_optimal_exposure():
     print("Calculating optimal exposure")
     global brightness_slope
     global brightness_intercept
     global g_exposure_absolute
     global best_brightness_diff
-    g_exposure_absolute = g_exposure_absolute_min
-    r1 = capture_and_calculate()
-    g_exposure_absolute = g_exposure_absolute_max
+    table = None
+    if not g_recalibrate:
+        table = CalibrationTable.load(g_calibration_file, calibration_settings())
+    if table is None:
+        table = calibrate()
+        table.save(g_calibration_file)
+    else:
+        print(f"Calibration loaded from {g_calibration_file}")
     # Reset diff before next capture
     best_brightness_diff = 1E10
-    r2 = capture_and_calculate()
-    brightness_slope = (r2['brightness'] - r1['brightness']) / \
-        (g_exposure_absolute_max - g_exposure_absolute_min)
-    brightness_intercept = r2['brightness'] - \
-        brightness_slope * g_exposure_absolute_max
-    g_exposure_absolute = int(
-        (g_brightness_optimal - brightness_intercept)/brightness_slope)
-    # This is a hack to account for the camera not giving us accurate images/exposures
-    if g_exposure_absolute <= g_exposure_absolute_min or g_exposure_absolute >= g_exposure_absolute_max:
-        g_exposure_absolute = int(
-            (g_exposure_absolute_min + g_exposure_absolute_max)/2)
+    # The sensor response isn't linear (saturation), the table is inverted
+    # by interpolating between the samples around the optimal brightness
+    g_exposure_absolute = int(table.exposure(g_brightness_optimal))
+    brightness_slope, brightness_intercept = table.slope(g_exposure_absolute)
+    if g_exposure_controller == "model":
+        g_controller.calibrate(brightness_slope, brightness_intercept)
     print(f"\nOptimal Exposure: {g_exposure_absolute}\n")
 
 
-def exists():
-    device_path = f"/dev/video{g_device}"
-    return os.path.exists(device_path)
+def init_hardware_crop(video_capture):
+    """Ask the driver to crop to the region we keep. Returns True if the frames
+    coming out of the camera are already cropped"""
+    left, top = g_xoffset, g_yoffset
+    width, height = g_width - 2*g_xoffset, g_height - 2*g_yoffset
+    try:
+        rect = video_capture.set_crop(left, top, width, height)
+        # Without a scaler the format has to match the crop rectangle
+        video_capture.set_format(width, height, "MJPG")
+        fmt = video_capture.get_format()
+    except OSError as e:
+        print(f"Hardware cropping not supported: {e}")
+        return False
+    if rect != (left, top, width, height) or (fmt.width, fmt.height) != (width, height):
+        print(f"Hardware cropping not usable: got {rect} at {fmt.width}x{fmt.height}")
+        video_capture.reset_crop()
+        video_capture.set_format(g_width, g_height, "MJPG")
+        return False
+    print(f"Hardware cropping enabled: {rect}")
+    return True
 
 
-def capture_and_calculate():
-    assert exists(), "Camera disconnected"
+CAMERA_CONTROLS = (
+    raw.V4L2_CID_EXPOSURE_AUTO,
+    raw.V4L2_CID_EXPOSURE_ABSOLUTE,
+    raw.V4L2_CID_CONTRAST,
+)
+
+
+def on_camera_event(event):
+    global g_applied_controls
+    # Changes we make ourselves are not reported back to us, so these come
+    # from another process or from the camera itself
+    print(f"Camera event: {event}")
+    log.warning(f"Camera event: {event}")
+    if event.type == EventType.CTRL and event.id in CAMERA_CONTROLS:
+        # The camera no longer has our controls: the next capture sets them
+        # again and waits for a frame exposed with them
+        g_applied_controls = None
+
+
+def subscribe_camera_events(device):
+    events = [(EventType.CTRL, control) for control in CAMERA_CONTROLS]
+    events.append((EventType.SOURCE_CHANGE, 0))
+    for event_type, event_id in events:
+        try:
+            device.subscribe_event(event_type, event_id)
+        except OSError as e:
+            print(f"Camera events {event_type.name}/{event_id} not supported: {e}")
+    device.event_handlers.append(on_camera_event)
+
+
+def set_mode(name):
+    """Switch the camera to the named mode ("meter" or "still")"""
+    global stream
+    stream = g_switcher.switch(name)
+
+
+def moving_average(previous, value, weight=0.2):
+    return value if previous is None else (1 - weight) * previous + weight * value
+
+
+def record_iteration(mode, start):
+    g_iteration_time[mode] = moving_average(
+        g_iteration_time.get(mode), time.monotonic() - start)
+
+
+def metering_pays_off():
+    """Whether switching to the metering mode and back is expected to cost less
+    than running the whole optimisation at full resolution"""
+    full = g_iteration_time.get("still")
+    meter = g_iteration_time.get("meter")
+    if full is None or meter is None or g_mean_attempts is None:
+        # Not measured yet
+        return True
+    switch = (g_switcher.latency("meter") or 0) + (g_switcher.latency("still") or 0)
+    return switch < g_mean_attempts * (full - meter)
+
+
+def next_frame(since, sequence=None):
+    """The first frame captured after the controls were changed at `since`
+    (time.monotonic()) and the number of stale frames skipped to get it.
+
+    With the sequence number of the last frame read before the change, the
+    frames the driver still holds are skipped by number rather than blindly"""
+    if sequence is None:
+        # Skip one frame: it may have been exposing while the controls changed
+        next(stream)
+    frame = next(stream)
+    stale = 0
+    # The driver may still hold frames captured before the change. Without
+    # monotonic timestamps we can't tell, so the skipped frame has to do
+    while stale < g_max_stale_frames and is_stale(frame, since, sequence):
+        stale += 1
+        frame = next(stream)
+    return frame, stale
+
+
+def is_stale(frame, since, sequence):
+    """Whether frame may have been exposed (partly) before `since`"""
+    if frame.monotonic is not None and frame.start_of_exposure:
+        # We know exactly when it started exposing
+        return frame.monotonic < since
+    # The frame after the last one read was already exposing during the
+    # change: a change costs two frame intervals unless the driver gives
+    # start of exposure timestamps
+    if sequence is not None and frame.sequence <= sequence + 1:
+        return True
+    return frame.monotonic is not None and frame.monotonic < since
+
+
+def frame_timings(frame, since, decoded, analysed):
+    """Latency stages of a frame in seconds. `captured` is kept as the
+    time.monotonic() of the capture so the response time can be added"""
+    captured = frame.monotonic
+    return {
+        "captured": frame.dequeued if captured is None else captured,
+        "captured_at": frame.wall_time,
+        "control_to_sensor": None if captured is None else captured - since,
+        "sensor_to_dqbuf": frame.latency,
+        "dqbuf_to_decode": decoded - frame.dequeued,
+        "decode_to_analysis": analysed - decoded,
+    }
+
+
+def estimate_luma(frame):
+    """Brightness (rms) and contrast (stddev) computed straight from the Y
+    samples of an uncompressed frame"""
+    fmt = frame.format
+    xoffset = 0 if g_hardware_crop else g_xoffset * fmt.width // g_width
+    yoffset = 0 if g_hardware_crop else g_yoffset * fmt.height // g_height
+    y = frame.luma()[yoffset:fmt.height - yoffset:g_meter_step,
+                     xoffset:fmt.width - xoffset:g_meter_step]
+    # Y from the camera is limited range (16-235) while the luma PIL gives us
+    # for JPEG is full range, so scale it to keep the same targets
+    y = numpy.clip((y.astype(numpy.float32) - 16) * (255 / 219), 0, 255)
+    return float(numpy.sqrt(numpy.mean(y * y))), float(y.std())
+
+
+def apply_controls():
+    """Send the exposure and contrast control to the camera"""
+    global g_applied_controls
     cam.video_capture.set_exposure(g_exposure_absolute)
     cam.video_capture.set_contrast(g_contrast_control)
-    # Skip one frame
-    next(stream)
-    im = next(stream)
+    g_applied_controls = g_exposure_absolute, g_contrast_control
+
+
+def capture_and_meter():
+    start = time.monotonic()
+    apply_controls()
+    since = time.monotonic()
+    frame, stale = next_frame(since)
+    # Nothing to decode
+    decoded = time.monotonic()
+    brightness, contrast = estimate_luma(frame)
+    record_iteration("meter", start)
+    return {
+        "exposure": g_exposure_absolute,
+        "contrast_control": g_contrast_control,
+        "brightness": brightness,
+        "contrast": contrast,
+        "hue": None,
+        "stale_frames": stale,
+        "timings": frame_timings(frame, since, decoded, time.monotonic()),
+    }
+
+
+def capture_and_calculate(settle=True):
+    """Capture and analyse a frame. Without settle the controls are only set
+    (and the frames exposed before skipped) if they were changed since they
+    were last sent to the camera"""
+    start = time.monotonic()
+    if settle or g_applied_controls != (g_exposure_absolute, g_contrast_control):
+        apply_controls()
+        since = time.monotonic()
+        im, stale = next_frame(since)
+    else:
+        # The controls haven't changed: the next frame will do, as long as
+        # it wasn't captured before we asked
+        since = time.monotonic()
+        im, stale = next(stream), 0
+        if im.monotonic is not None and im.monotonic < since:
+            im, stale = next(stream), 1
     image_bytes = BytesIO(im)
-    image = Image.open(image_bytes)
-    width = image.size[0]
-    height = image.size[1]
-    image = image.crop((g_xoffset, g_yoffset, width -
-                       g_xoffset, height - g_yoffset))
+    image = decode(image_bytes)
+    decoded = time.monotonic()
+    metrics = analyse(image)
     result = {
         "exposure": g_exposure_absolute,
         "contrast_control": g_contrast_control,
         "image": image_bytes,
-        "brightness": estimate_brightness(image),
-        "contrast": estimate_contrast(image),
-        "hue": estimate_hue(image)
+        **metrics,
+        "stale_frames": stale,
     }
+    result["timings"] = frame_timings(im, since, decoded, time.monotonic())
+    record_iteration("still", start)
     return result
 
 
+def adjust(ret):
+    """Move the controls towards the targets from a measurement. Returns
+    True if the measurement was already within the tolerances"""
+    global g_exposure_absolute
+    global g_contrast_control
+    brightness = ret['brightness']
+    hue = ret['hue']
+    contrast = ret['contrast']
+    brightness_diff = g_brightness_optimal - brightness
+    contrast_diff = g_contrast_optimal - contrast
+    is_brightness_optimised = not(g_enable_brightness_optimisation) or abs(
+        brightness_diff) <= g_brightness_diff
+    is_hue_optimised = not(g_enable_hue_optimisation) or not (g_hue_min <= hue <= g_hue_max) 
+    is_contrast_optimised = not(g_enable_contrast_optimisation) or abs(
+        contrast_diff) <= g_contrast_diff
+    if is_brightness_optimised and is_hue_optimised and is_contrast_optimised:
+        return True
+    if not is_brightness_optimised:
+        g_exposure_absolute = g_controller.update(
+            g_exposure_absolute, brightness)
+    if not is_contrast_optimised:
+        g_contrast_control += int((contrast_diff /
+                                   abs(contrast_diff))*g_contrast_control_step)
+        if g_contrast_control > g_contrast_control_max:
+            g_contrast_control = g_contrast_control_max
+        elif g_contrast_control < g_contrast_control_min:
+            g_contrast_control = g_contrast_control_min
+    return False
+
+
+def warm_start():
+    global g_exposure_absolute
+    global g_contrast_control
+    if g_warm_starts:
+        start = g_warm_starts.suggest()
+        if start:
+            g_exposure_absolute = start['exposure']
+            g_contrast_control = start['contrast_control']
+
+
+def full_analysis(frame):
+    """Decode and analyse a frame (run on the analysis worker)"""
+    image_bytes = BytesIO(frame)
+    image = decode(image_bytes)
+    decoded = time.monotonic()
+    return image_bytes, analyse(image), decoded, time.monotonic()
+
+
 def optimise():
     global g_exposure_absolute
     global g_contrast_control
     global best_exposure
+    global g_mean_attempts
     best_brightness_diff = 1E10
     ret = {}
     count = 0
+    measure = capture_and_calculate
+    metering = g_meter_yuyv and metering_pays_off()
+    if metering:
+        set_mode("meter")
+        measure = capture_and_meter
+    if g_metering_quality:
+        cam.video_capture.set_jpeg_quality(g_metering_quality)
+    warm_start()
+    g_controller.begin()
     for count in range(0, g_max_attempts):
-        ret = capture_and_calculate()
+        ret = measure()
         print(f"{ret}")
-        brightness = ret['brightness']
-        hue = ret['hue']
-        contrast = ret['contrast']
-        brightness_diff = g_brightness_optimal - brightness
-        contrast_diff = g_contrast_optimal - contrast
+        brightness_diff = g_brightness_optimal - ret['brightness']
         if abs(brightness_diff) < abs(best_brightness_diff):
             # An optimisation was found
             best_brightness_diff = brightness_diff
             best_exposure = g_exposure_absolute
-        is_brightness_optimised = not(g_enable_brightness_optimisation) or abs(
-            brightness_diff) <= g_brightness_diff
-        is_hue_optimised = not(g_enable_hue_optimisation) or not (g_hue_min <= hue <= g_hue_max) 
-        is_contrast_optimised = not(g_enable_contrast_optimisation) or abs(
-            contrast_diff) <= g_contrast_diff
-        if not (is_brightness_optimised and is_hue_optimised and is_contrast_optimised):
-            if not is_brightness_optimised:
-                g_exposure_absolute += int((brightness_diff /
-                                            abs(brightness_diff))*g_exposure_absolute_step)
-                if g_exposure_absolute > g_exposure_absolute_max:
-                    g_exposure_absolute = g_exposure_absolute_max
-                elif g_exposure_absolute < g_exposure_absolute_min:
-                    g_exposure_absolute = g_exposure_absolute_min
-            if not is_contrast_optimised:
-                g_contrast_control += int((contrast_diff /
-                                           abs(contrast_diff))*g_contrast_control_step)
-                if g_contrast_control > g_contrast_control_max:
-                    g_contrast_control = g_contrast_control_max
-                elif g_contrast_control < g_contrast_control_min:
-                    g_contrast_control = g_contrast_control_min
-        else:
+        if adjust(ret):
             print("\nOptimised!\n")
+            if g_warm_starts:
+                g_warm_starts.record(
+                    ret['exposure'], ret['contrast_control'], ret['brightness'])
             g_exposure_absolute = best_exposure
             break
-    now = int(datetime.now().timestamp())
-    tmppath = f"/tmp/{now}.jpg"
-    fpath = f"{g_path}/{now}.jpg"
+    g_mean_attempts = moving_average(g_mean_attempts, count + 1)
+    if metering:
+        set_mode("still")
+    if g_metering_quality:
+        cam.video_capture.set_jpeg_quality(g_still_quality)
+    if metering or g_metering_quality:
+        # Only the frame we keep needs to be at full resolution and quality
+        ret = capture_and_calculate()
+    return store(ret, count + 1)
+
+
+def optimise_pipelined():
+    """optimise() with the next controls chosen from a provisional estimate
+    (1/8 scale decode) of each frame while its full analysis runs on a worker, during
+    the exposure of the next frame. The full analyses correct the bias of the
+    estimates and confirm the frame we keep.
+
+    Frames are matched to the controls they were exposed with by sequence
+    number (and timestamp), so only frames which may have been exposing
+    during a change are skipped"""
+    global g_exposure_absolute
+    global g_mean_attempts
+    warm_start()
+    g_controller.begin()
+    sequence = None
+    analysis = previous = None
+    optimised = False
+    for count in range(0, g_max_attempts):
+        start = time.monotonic()
+        ret = {
+            "exposure": g_exposure_absolute,
+            "contrast_control": g_contrast_control,
+        }
+        apply_controls()
+        since = time.monotonic()
+        frame, ret["stale_frames"] = next_frame(since, sequence)
+        # Only matched by number while the driver numbers the frames
+        if frame.sequence and (sequence is None or frame.sequence > sequence):
+            sequence = frame.sequence
+        else:
+            sequence = None
+        estimate = analyse(decode(BytesIO(frame), 8))
+        analysis = g_analysis.submit(full_analysis, frame)
+        if previous is not None:
+            # Done while we were waiting for this frame
+            update_bias(*previous)
+        previous = dict(estimate), analysis
+        for name, bias in g_estimate_bias.items():
+            estimate[name] += bias
+        print(f"{ret} estimate {estimate}")
+        record_iteration("pipeline", start)
+        if not adjust(estimate):
+            # The next controls are set while the worker analyses this frame
+            continue
+        # Confirm with the full analysis
+        update_bias(*previous)
+        previous = None
+        if adjust(analysis.result()[1]):
+            print("\nOptimised!\n")
+            optimised = True
+            break
+    image_bytes, metrics, decoded, analysed = analysis.result()
+    ret.update(image=image_bytes, **metrics)
+    ret["timings"] = frame_timings(frame, since, decoded, analysed)
+    if g_warm_starts and optimised:
+        g_warm_starts.record(
+            ret['exposure'], ret['contrast_control'], ret['brightness'])
+    g_mean_attempts = moving_average(g_mean_attempts, count + 1)
+    return store(ret, count + 1)
+
+
+def update_bias(estimate, analysis):
+    """Follow the difference between the full analysis and the estimate"""
+    metrics = analysis.result()[1]
+    for name in g_estimate_bias:
+        g_estimate_bias[name] = moving_average(
+            g_estimate_bias[name], metrics[name] - estimate[name], weight=0.5)
+
+
+def capture_tracked():
+    """The next frame within the tolerances, the tracker keeps the controls
+    converged so it is usually the very next frame"""
+    deadline = time.monotonic() + g_track_timeout
+    for count in range(1, g_max_attempts + 1):
+        # Controls are only set again if they were adjusted, here or by the
+        # tracker
+        ret = capture_and_calculate(settle=False)
+        if adjust(ret) or time.monotonic() > deadline:
+            break
+        print(f"Not converged: {ret['brightness']:.1f}/{ret['contrast']:.1f}")
+    return store(ret, count)
+
+
+def store(ret, attempts):
+    """Queue the image of a capture to be written to g_path and indexed"""
     image = ret.pop('image')
-    with open(tmppath, 'wb') as f:
-        f.write(image.getbuffer())
-    # Only needed until we figure out how to use crop directly within v4l2
-    call(f"convert {tmppath} -crop {g_width-2*g_xoffset}x{g_height-2*g_yoffset}+{g_xoffset}+{g_yoffset} {fpath}", shell=True)
+    if g_hardware_crop:
+        # The camera already delivers the region we keep
+        data = image.getvalue()
+    else:
+        data = crop_frame(image)
+    ret['attempts'] = attempts
+    # Indexed once the image is stored
+    metrics = {name: ret[name] for name in METRICS if name in ret}
+    captured_at = ret['timings']['captured_at']
+    if g_embed_metadata:
+        # EXIF ImageDescription spliced in, the image isn't re-encoded
+        description = json.dumps({**metrics, "captured_at": captured_at})
+        data = jpeg.insert_segment(data, jpeg.APP1, jpeg.exif(
+            description, datetime.fromtimestamp(captured_at), "accumen_camera"))
+    # Only reserved once the data is ready: a frame we fail to crop leaves
+    # no pending file behind
+    fpath = g_writer.reserve(g_path, int(datetime.now().timestamp()))
     ret['path'] = fpath
-    ret['attempts'] = count + 1
+    # Indexed before retention hears of the file, so a removal is always
+    # recorded after the capture
+    g_writer.submit(fpath, data, on_write=lambda path, size: g_index.add(
+        path, size, captured_at, **metrics))
     return ret
 
 
+def restart_stream():
+    """Replace the frame iterator after it failed, which also reopens the
+    camera if it was lost"""
+    global stream
+    if g_switcher:
+        stream = g_switcher.restart()
+    else:
+        stream.close()
+        stream = iter(cam)
+
+
+def on_stream(func):
+    """func() with the camera lock held, on a live frame iterator"""
+    global g_stream_failed
+    with g_camera_lock:
+        if g_stream_failed:
+            restart_stream()
+            g_stream_failed = False
+        try:
+            return func()
+        except StopIteration:
+            g_stream_failed = True
+            raise RuntimeError("Camera stream ended")
+        except OSError:
+            g_stream_failed = True
+            raise
+
+
+def capture():
+    if g_track:
+        return on_stream(capture_tracked)
+    if g_pipeline:
+        return on_stream(optimise_pipelined)
+    return on_stream(optimise)
+
+
+def track_iteration():
+    with g_camera_lock:
+        ret = on_stream(capture_and_calculate)
+        ret.pop('image')
+        return ret, adjust(ret)
+
+
+def track():
+    """Keep the exposure and contrast converged on the live stream, metering
+    a frame every g_track_interval seconds once converged, or once it gave
+    up after g_max_attempts iterations (the scene is out of reach)"""
+    g_controller.begin()
+    # Iterations since we last converged
+    attempts = 0
+    while not g_tracker_stop.is_set():
+        try:
+            if g_worker:
+                ret, converged = g_worker.run(track_iteration)
+            else:
+                ret, converged = track_iteration()
+        except Exception as e:
+            log.error(f"Tracker: {e}")
+            g_tracker.update(state="error", error=str(e))
+            g_tracker_stop.wait(g_track_interval)
+            continue
+        if converged and not g_tracker["converged"] and g_warm_starts:
+            g_warm_starts.record(
+                ret['exposure'], ret['contrast_control'], ret['brightness'])
+        attempts = 0 if converged else attempts + 1
+        if converged:
+            state = "converged"
+        elif attempts < g_max_attempts:
+            state = "converging"
+        else:
+            state = "unconverged"
+        g_tracker.update(
+            state=state,
+            converged=converged,
+            iterations=g_tracker["iterations"] + 1,
+            exposure=ret['exposure'],
+            contrast_control=ret['contrast_control'],
+            brightness=ret['brightness'],
+            contrast=ret['contrast'],
+            hue=ret['hue'],
+            time=ret['timings']['captured_at'],
+            error=None,
+        )
+        # Meter slowly once converged (or unconverged), converge as fast as
+        # we can
+        if state != "converging":
+            g_tracker_stop.wait(g_track_interval)
+
+
+def float_arg(name):
+    value = flask.request.args.get(name)
+    return None if value is None else float(value)
+
+
+def bool_arg(name):
+    return flask.request.args.get(name, "0").lower() in ("1", "true", "yes")
+
+
 @app.get("/")
 def index():
     result = {"time": datetime.now().timestamp()}
@@ -204,13 +801,64 @@ def index():
 @app.post("/")
 def trigger():
     try:
-        result = optimise()
+        start = time.monotonic()
+        if g_worker:
+            result = g_worker.run(capture)
+        else:
+            result = capture()
+        timings = result["timings"]
+        now = time.monotonic()
+        timings["sensor_to_response"] = now - timings.pop("captured")
+        timings["request"] = now - start
+        if bool_arg("wait"):
+            # Only answer once the image is safely stored
+            g_writer.wait(result["path"])
+        result["storage"] = g_writer.status(result["path"])
         return success(result)
     except Exception as e:
         print(str(e))
         return error(message=str(e), status=404)
 
 
+@app.get("/captures")
+def captures():
+    """Captures from the index. Filters: since/until (timestamps) and
+    min_<metric>/max_<metric>, eg. /captures?since=1640995200&min_brightness=30"""
+    try:
+        ranges = {
+            key: float_arg(key) for key in flask.request.args
+            if key.startswith(("min_", "max_"))
+        }
+        result = g_index.query(
+            since=float_arg("since"),
+            until=float_arg("until"),
+            limit=int(flask.request.args.get("limit", 100)),
+            removed=bool_arg("removed"),
+            **ranges)
+    except ValueError as e:
+        return error(message=str(e), status=400)
+    return success({"captures": result})
+
+
+@app.get("/tracker")
+def tracker_status():
+    return success({"tracker": g_tracker})
+
+
+@app.get("/storage")
+def storage_status():
+    path = flask.request.args.get("path")
+    result = {"pending": g_writer.pending}
+    if g_retention:
+        result["retention"] = g_retention.stats()
+    if path:
+        status = g_writer.status(path)
+        if status is None:
+            return error(message=f"Unknown path {path}", status=404)
+        result.update(path=path, status=status)
+    return success(result)
+
+
 @app.post("/logs")
 def store_logs():
     print(flask.request.json)
@@ -221,19 +869,38 @@ def start(
         host: str = default_host,
         port: int = 8000,
         device: int = g_device,
+        recover_timeout: float = g_recover_timeout,
         width: int = 3264,
         height: int = 2448,
         xoffset: int = g_xoffset,
         yoffset: int = g_yoffset,
         skip: int = 2,
         max_attempts: int = g_max_attempts,
+        max_stale_frames: int = g_max_stale_frames,
+        capture_cpus: str = g_capture_cpus,
+        capture_priority: int = g_capture_priority,
+        capture_nice: int = g_capture_nice,
+        metering_quality: int = g_metering_quality,
+        meter_yuyv: bool = g_meter_yuyv,
+        meter_width: int = g_meter_width,
+        meter_height: int = g_meter_height,
+        meter_step: int = g_meter_step,
+        meter_scale: int = g_meter_scale,
         brightness_optimal: int = g_brightness_optimal,
         brightness_diff: int = g_brightness_diff,
         enable_single_color_rejection: bool = g_enable_single_color_rejection,
         enable_brightness_optimisation: bool = g_enable_brightness_optimisation,
         enable_hue_optimisation: bool = g_enable_hue_optimisation,
         enable_contrast_optimisation: bool = g_enable_contrast_optimisation,
+        enable_hardware_crop: bool = g_enable_hardware_crop,
         path: str = g_path,
+        storage_queue: int = g_storage_queue,
+        storage_fsync: str = g_storage_fsync,
+        retention_max_mb: int = g_retention_max_mb,
+        retention_max_days: float = g_retention_max_days,
+        retention_max_count: int = g_retention_max_count,
+        index_path: str = g_index_path,
+        embed_metadata: bool = g_embed_metadata,
         hue_min: int = g_hue_min,
         hue_max: int = g_hue_max,
         contrast_optimal: int = g_contrast_optimal,
@@ -245,6 +912,16 @@ def start(
         exposure_absolute_max: int = g_exposure_absolute_max,
         exposure_absolute_step: int = g_exposure_absolute_step,
         exposure_auto: bool = typer.Option(g_exposure_auto),
+        exposure_controller: str = g_exposure_controller,
+        calibration_points: int = g_calibration_points,
+        calibration_file: str = g_calibration_file,
+        recalibrate: bool = g_recalibrate,
+        warm_start: bool = g_warm_start,
+        warm_start_file: str = g_warm_start_file,
+        track: bool = g_track,
+        track_interval: float = g_track_interval,
+        track_timeout: float = g_track_timeout,
+        pipeline: bool = g_pipeline,
         version: bool = typer.Option(False),
         servicename: str = "camera",
         logfile: str = "accumen_camera.log",
@@ -253,13 +930,28 @@ def start(
         print("0.1.0")
         exit(0)
     global g_device
+    global g_recover_timeout
     global g_path
+    global g_storage_queue
+    global g_storage_fsync
+    global g_writer
+    global g_retention_max_mb
+    global g_retention_max_days
+    global g_retention_max_count
+    global g_retention
+    global g_index_path
+    global g_index
+    global g_embed_metadata
+    global g_width
+    global g_height
     global g_xoffset
     global g_yoffset
     global g_enable_single_color_rejection
     global g_enable_brightness_optimisation
     global g_enable_hue_optimisation
     global g_enable_contrast_optimisation
+    global g_enable_hardware_crop
+    global g_hardware_crop
     global g_brightness_optimal
     global g_brightness_diff
     global g_hue_min
@@ -273,16 +965,46 @@ def start(
     global g_exposure_absolute_max
     global g_exposure_absolute_step
     global g_exposure_auto
+    global g_exposure_controller
+    global g_controller
+    global g_calibration_points
+    global g_calibration_file
+    global g_recalibrate
+    global g_warm_start
+    global g_warm_start_file
+    global g_warm_starts
+    global g_track
+    global g_track_interval
+    global g_track_timeout
+    global g_pipeline
+    global g_analysis
     global g_max_attempts
+    global g_max_stale_frames
+    global g_capture_cpus
+    global g_capture_priority
+    global g_capture_nice
+    global g_worker
+    global g_metering_quality
+    global g_meter_yuyv
+    global g_meter_width
+    global g_meter_height
+    global g_meter_step
+    global g_meter_scale
+    global g_switcher
+    global g_still_quality
     global cam
     global stream
     g_device = device
+    g_recover_timeout = recover_timeout
+    g_width = width
+    g_height = height
     g_xoffset = xoffset
     g_yoffset = yoffset
     g_enable_single_color_rejection = enable_single_color_rejection
     g_enable_brightness_optimisation = enable_brightness_optimisation
     g_enable_hue_optimisation = enable_hue_optimisation
     g_enable_contrast_optimisation = enable_contrast_optimisation
+    g_enable_hardware_crop = enable_hardware_crop
     g_hue_min = hue_min
     g_hue_max = hue_max
     g_contrast_optimal = contrast_optimal
@@ -295,10 +1017,81 @@ def start(
     g_exposure_auto = exposure_auto
     g_exposure_absolute_min = exposure_absolute_min
     g_exposure_absolute_max = exposure_absolute_max
+    # The calibration measures at least two exposures, spread geometrically
+    assert 0 < g_exposure_absolute_min < g_exposure_absolute_max, \
+        "exposure_absolute_min must be positive and below exposure_absolute_max"
     g_exposure_absolute_step = exposure_absolute_step
+    g_exposure_controller = exposure_controller
+    g_calibration_points = calibration_points
+    g_calibration_file = calibration_file or os.path.join(path, "calibration.json")
+    g_recalibrate = recalibrate
+    g_warm_start = warm_start
+    g_warm_start_file = warm_start_file or os.path.join(path, "warm_start.json")
+    if g_warm_start:
+        g_warm_starts = WarmStart(g_warm_start_file)
+    g_track = track
+    g_track_interval = track_interval
+    g_track_timeout = track_timeout
+    g_pipeline = pipeline
+    if g_exposure_controller == "model":
+        g_controller = ModelController(
+            g_brightness_optimal, g_brightness_diff,
+            g_exposure_absolute_min, g_exposure_absolute_max)
+    elif g_exposure_controller == "step":
+        g_controller = StepController(
+            g_brightness_optimal, g_brightness_diff,
+            g_exposure_absolute_min, g_exposure_absolute_max,
+            g_exposure_absolute_step)
+    else:
+        print(f"Unknown exposure controller '{g_exposure_controller}'")
+        exit(1)
     g_path = path
+    g_storage_queue = storage_queue
+    g_storage_fsync = storage_fsync
+    g_retention_max_mb = retention_max_mb
+    g_retention_max_days = retention_max_days
+    g_retention_max_count = retention_max_count
+    g_index_path = index_path or os.path.join(path, "captures.db")
+    g_embed_metadata = embed_metadata
     g_max_attempts = max_attempts
+    g_max_stale_frames = max_stale_frames
+    g_capture_cpus = capture_cpus
+    g_capture_priority = capture_priority
+    g_capture_nice = capture_nice
+    g_metering_quality = metering_quality
+    g_meter_yuyv = meter_yuyv
+    g_meter_width = meter_width
+    g_meter_height = meter_height
+    g_meter_step = meter_step
+    g_meter_scale = meter_scale
+    assert g_meter_scale in (1, 2, 4, 8), "meter_scale must be 1, 2, 4 or 8"
+    if g_meter_yuyv and g_enable_hue_optimisation:
+        print("Hue optimisation needs colour, metering on MJPG frames")
+        g_meter_yuyv = False
+    if g_pipeline and (g_enable_hue_optimisation or g_meter_yuyv):
+        print("Pipelined optimisation estimates luma from MJPEG frames only")
+        g_pipeline = False
+    if g_pipeline and g_metering_quality:
+        print("Pipelined optimisation keeps the frames it meters, "
+              "not using a metering quality")
+        g_pipeline = False
+    if g_pipeline:
+        g_analysis = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="analysis")
     assert os.path.exists(g_path), f"Directory '{g_path}' does not exist"
+    g_index = CaptureIndex(g_index_path)
+    on_write = None
+    if g_retention_max_mb or g_retention_max_days or g_retention_max_count:
+        g_retention = Retention(
+            g_path,
+            max_bytes=g_retention_max_mb * 1024 * 1024,
+            max_age=g_retention_max_days * 24 * 3600,
+            max_count=g_retention_max_count,
+            on_remove=g_index.removed,
+        )
+        on_write = g_retention.add
+    # Images are written in the background, requests don't wait for storage
+    g_writer = Writer(g_storage_queue, g_storage_fsync, on_write=on_write)
     logging.basicConfig(
         level=logging.DEBUG,
         filename=logfile,
@@ -308,20 +1101,59 @@ def start(
         init_service(host=None, port=port, name=servicename)
     else:
         init_service(host=host, port=port, name=servicename)
+    if g_capture_cpus or g_capture_priority or g_capture_nice:
+        # Capture and decode get their own thread so DQBUF is serviced in
+        # time whatever the Flask threads are doing
+        g_worker = CaptureWorker(
+            parse_cpus(g_capture_cpus), g_capture_priority, g_capture_nice)
+        print(f"Capture thread: {g_worker.start()}")
     print("Starting Camera")
-    with Device.from_id(device) as cam:
+    # A disconnected camera is reopened transparently (by bus_info) and
+    # its format, controls and buffers restored
+    with Device.from_id(device, recover_timeout=g_recover_timeout) as cam:
         # Camera is now open and locked.
         # And it's held open until we close it
         cam.video_capture.set_format(width, height, "MJPG")
-        # WIP: Cropping does not appear to be supported by this camera.
-        #cam.video_capture.set_crop(xoffset, yoffset, width, height)
-        stream = iter(cam)
-        # Camera is started once we call next(stream)
-        # We skip a few frames at the start
-        for i in range(skip):
-            next(stream)
-        calc_optimal_exposure()
+        subscribe_camera_events(cam)
+        if g_enable_hardware_crop:
+            g_hardware_crop = init_hardware_crop(cam.video_capture)
+        if g_metering_quality:
+            if cam.video_capture.jpeg_quality_method:
+                g_still_quality = cam.video_capture.get_jpeg_quality()
+            else:
+                print("JPEG quality control not supported, metering at full quality")
+                g_metering_quality = 0
+        if g_meter_yuyv:
+            fmt = cam.video_capture.get_format()
+            g_switcher = ModeSwitcher(cam.video_capture, {
+                "meter": Mode(g_meter_width, g_meter_height, "YUYV", skip=skip),
+                "still": Mode(fmt.width, fmt.height, "MJPG", skip=skip),
+            })
+            g_switcher.prepare()
+            stream = g_switcher.switch("still")
+        else:
+            stream = iter(cam)
+            # Camera is started once we call next(stream)
+            # We skip a few frames at the start
+            for i in range(skip):
+                next(stream)
+        report_crop(next(stream))
+        if g_worker:
+            g_worker.run(calc_optimal_exposure)
+        else:
+            calc_optimal_exposure()
+        if g_track:
+            g_tracker["state"] = "converging"
+            tracker = threading.Thread(target=track, name="tracker", daemon=True)
+            tracker.start()
         app.run(host=host, port=port)
+        if g_track:
+            g_tracker_stop.set()
+            tracker.join()
+    g_writer.close()
+    if g_retention:
+        g_retention.close()
+    g_index.close()
 
 if __name__ == "__main__":
     typer.run(start)
@@ -0,0 +1,85 @@
+"""Compare metering on draft (luma only, DCT scaled) decodes against the full
+colour decode.
+
+    python bench_draft.py /tmp/*.jpg --xoffset 408
+
+At 1/8 libjpeg only uses the DC coefficient of each 8x8 block, the pixels
+are the block means: the detail within the blocks is lost so the contrast
+comes out lower. Check the errors against --brightness-diff/--contrast-diff
+before metering (or estimating, with --pipeline) at that scale.
+
+Without frames a synthetic 3264x2448 frame is used, which says something
+about speed but little about accuracy: record a few real frames first.
+"""
+import time
+import typer
+import numpy
+from io import BytesIO
+from typing import List
+from PIL import Image, ImageStat
+
+SCALES = (1, 2, 4, 8)
+# the full colour decode + convert('L') we compare to
+FULL = 0
+
+
+def synthetic_frame(width=3264, height=2448):
+    y, x = numpy.mgrid[0:height, 0:width]
+    noise = numpy.random.default_rng(0).normal(0, 20, (height, width))
+    luma = numpy.clip(64 + 96 * x / width + 32 * numpy.sin(y / 40) + noise, 0, 255)
+    rgb = numpy.stack([luma, luma * 0.9, luma * 0.8], axis=-1).astype(numpy.uint8)
+    data = BytesIO()
+    Image.fromarray(rgb).save(data, "JPEG", quality=85)
+    return data.getvalue()
+
+
+def meter(data, scale, xoffset, yoffset):
+    image = Image.open(BytesIO(data))
+    width, height = image.size
+    if scale != FULL:
+        image.draft('L', (width // scale, height // scale))
+    image.load()
+    xoffset = xoffset * image.size[0] // width
+    yoffset = yoffset * image.size[1] // height
+    image = image.crop((xoffset, yoffset, image.size[0] -
+                        xoffset, image.size[1] - yoffset))
+    im = image if image.mode == 'L' else image.convert('L')
+    stat = ImageStat.Stat(im)
+    return stat.rms[0], stat.stddev[0]
+
+
+def main(frames: List[str] = typer.Argument(None),
+         xoffset: int = 408,
+         yoffset: int = 0,
+         repeat: int = 3):
+    if frames:
+        names = frames
+        datas = [open(name, "rb").read() for name in frames]
+    else:
+        names = ["synthetic"]
+        datas = [synthetic_frame()]
+    times = {scale: [] for scale in (FULL, *SCALES)}
+    errors = {scale: [] for scale in (FULL, *SCALES)}
+    for name, data in zip(names, datas):
+        reference = meter(data, FULL, xoffset, yoffset)
+        for scale in times:
+            for i in range(repeat):
+                start = time.perf_counter()
+                result = meter(data, scale, xoffset, yoffset)
+                times[scale].append(time.perf_counter() - start)
+            errors[scale].append([r - f for r, f in zip(result, reference)])
+        print(f"{name}: brightness {reference[0]:.2f} contrast {reference[1]:.2f}")
+    full = numpy.mean(times[FULL])
+    print(f"\n{'scale':>5} {'ms':>8} {'speedup':>8} "
+          f"{'brightness err (mean/max)':>26} {'contrast err (mean/max)':>24}")
+    for scale in times:
+        mean = numpy.mean(times[scale])
+        err = numpy.abs(numpy.array(errors[scale]))
+        label = "RGB" if scale == FULL else f"1/{scale}"
+        print(f"{label:<5} {mean * 1000:8.1f} {full / mean:8.1f} "
+              f"{err[:, 0].mean():13.2f}/{err[:, 0].max():<12.2f}"
+              f"{err[:, 1].mean():11.2f}/{err[:, 1].max():<12.2f}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
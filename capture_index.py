@@ -0,0 +1,110 @@
+import time
+import sqlite3
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Columns which can be filtered on with min_<name>/max_<name>
+METRICS = (
+    "exposure", "contrast_control", "brightness", "contrast", "hue",
+    "attempts", "size",
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    captured_at REAL NOT NULL,
+    stored_at REAL NOT NULL,
+    exposure INTEGER,
+    contrast_control INTEGER,
+    brightness REAL,
+    contrast REAL,
+    hue REAL,
+    attempts INTEGER,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS captures_captured_at ON captures (captured_at);
+CREATE TABLE IF NOT EXISTS removals (
+    path TEXT NOT NULL,
+    removed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS removals_path ON removals (path);
+"""
+
+
+class CaptureIndex:
+    """Append only index of the captures in SQLite (WAL mode, so readers
+    don't block the writer). Rows are never updated: deleting a file appends
+    a removal instead"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # WAL stays consistent after a crash with NORMAL, we may only lose
+        # the last few captures
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, path, size, captured_at=None, **metrics):
+        row = {name: metrics.get(name) for name in METRICS}
+        row.update(
+            path=path,
+            size=size,
+            captured_at=time.time() if captured_at is None else captured_at,
+            stored_at=time.time(),
+        )
+        names = ", ".join(row)
+        values = ", ".join(f":{name}" for name in row)
+        with self._lock, self._db:
+            self._db.execute(f"INSERT INTO captures ({names}) VALUES ({values})", row)
+
+    def removed(self, paths):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO removals (path, removed_at) VALUES (?, ?)",
+                [(path, now) for path in paths])
+
+    def query(self, since=None, until=None, limit=100, removed=False, **ranges):
+        """Captures between since and until (time.time() values), newest
+        first. ranges are min_<metric>/max_<metric> bounds"""
+        where = []
+        args = []
+        if since is not None:
+            where.append("captured_at >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("captured_at < ?")
+            args.append(until)
+        for key, value in ranges.items():
+            bound, _, name = key.partition("_")
+            if name not in METRICS or bound not in ("min", "max"):
+                raise ValueError(f"Unknown filter {key!r}")
+            where.append(f"{name} {'>=' if bound == 'min' else '<='} ?")
+            args.append(value)
+        if not removed:
+            where.append(
+                "NOT EXISTS (SELECT 1 FROM removals r WHERE r.path = captures.path"
+                " AND r.removed_at >= captures.stored_at)")
+        sql = "SELECT * FROM captures"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY captured_at DESC LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, args)]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
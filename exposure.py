@@ -0,0 +1,259 @@
+import os
+import json
+import math
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def clamp(value, minimum, maximum):
+    return max(minimum, min(maximum, value))
+
+
+class StepController:
+    """Move the exposure by a fixed step towards the target brightness"""
+
+    def __init__(self, target, tolerance, minimum, maximum, step=25):
+        self.target = target
+        self.tolerance = tolerance
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+
+    def begin(self):
+        pass
+
+    def update(self, exposure, brightness):
+        """The exposure to try after measuring brightness at exposure"""
+        error = self.target - brightness
+        if abs(error) <= self.tolerance:
+            return exposure
+        step = self.step if error > 0 else -self.step
+        return clamp(exposure + step, self.minimum, self.maximum)
+
+
+class ModelController:
+    """Find the exposure giving the target brightness with secant (Newton)
+    steps on a linear brightness = slope * exposure + intercept model.
+
+    The model is refined from every measurement. The first measurement of
+    a search gives the slope of the line through it and the black level
+    (the brightness at zero exposure, from calibrate()), which follows
+    changes of the scene. Following measurements give the slope of the
+    secant through the last two. Steps are damped, limited to max_change of
+    the exposure range and clamped to the range"""
+
+    def __init__(self, target, tolerance, minimum, maximum, resolution=1,
+                 black=0, damping=0.9, max_change=0.5):
+        self.target = target
+        self.tolerance = tolerance
+        self.minimum = minimum
+        self.maximum = maximum
+        self.resolution = resolution
+        self.black = black
+        self.slope = None
+        self.intercept = black
+        self.damping = damping
+        self.max_change = max_change
+        self._last = None
+
+    def begin(self):
+        """Start a new search: the scene may have changed since the last
+        measurement so it isn't used for the slope"""
+        self._last = None
+
+    def calibrate(self, slope, intercept):
+        """Use a model fitted elsewhere (eg. from two captures)"""
+        if slope > 0:
+            self.slope = slope
+            self.intercept = intercept
+            self.black = max(intercept, 0)
+
+    def predict(self, brightness):
+        """Exposure giving brightness according to the model"""
+        return (brightness - self.intercept) / self.slope
+
+    def _refine(self, exposure, brightness):
+        if self._last is None:
+            slope = (brightness - self.black) / exposure if exposure else 0
+        else:
+            last_exposure, last_brightness = self._last
+            slope = 0
+            if exposure != last_exposure:
+                slope = (brightness - last_brightness) / (exposure - last_exposure)
+        # a flat or negative slope (saturation, noise) says nothing useful
+        # about where to go next, keep the previous one
+        if slope > 0:
+            self.slope = slope
+        if self.slope is not None:
+            self.intercept = brightness - self.slope * exposure
+        self._last = exposure, brightness
+
+    def update(self, exposure, brightness):
+        """The exposure to try after measuring brightness at exposure"""
+        self._refine(exposure, brightness)
+        error = self.target - brightness
+        if abs(error) <= self.tolerance:
+            return exposure
+        if self.slope is not None:
+            change = self.damping * error / self.slope
+        else:
+            # black: no idea how far, go as far as we can
+            change = self.maximum - exposure
+        limit = self.max_change * (self.maximum - self.minimum)
+        change = clamp(change, -limit, limit)
+        new = clamp(exposure + change, self.minimum, self.maximum)
+        new = clamp(int(round(new / self.resolution) * self.resolution),
+                    self.minimum, self.maximum)
+        if new == exposure:
+            # rounded away: move by the smallest step we can
+            step = self.resolution if error > 0 else -self.resolution
+            new = clamp(exposure + step, self.minimum, self.maximum)
+        log.debug(f"exposure {exposure} brightness {brightness:.1f} -> {new}"
+                  f" (slope {self.slope})")
+        return new
+
+
+def monotone(values):
+    """Closest non decreasing sequence to values (pool adjacent violators)"""
+    blocks = []
+    for value in values:
+        blocks.append([value, 1])
+        while len(blocks) > 1 and blocks[-2][0] > blocks[-1][0]:
+            value, weight = blocks.pop()
+            mean, total = blocks[-1]
+            blocks[-1] = [(mean * total + value * weight) / (total + weight),
+                          total + weight]
+    return [mean for mean, weight in blocks for i in range(weight)]
+
+
+class CalibrationTable:
+    """Brightness measured at a set of exposures, made monotone, and inverted
+    by linear interpolation to find the exposure giving a brightness.
+
+    settings are the conditions of the calibration (exposure range, contrast
+    control...): a table saved with different settings isn't loaded"""
+
+    def __init__(self, points=(), settings=None):
+        self.settings = settings or {}
+        points = sorted(points)
+        self.exposures = [exposure for exposure, _ in points]
+        self.brightnesses = monotone([brightness for _, brightness in points])
+
+    @staticmethod
+    def exposures_between(minimum, maximum, count):
+        """count exposures spread geometrically between minimum and maximum:
+        the response changes the most at short exposures"""
+        count = max(count, 2)
+        ratio = (maximum / minimum) ** (1 / (count - 1))
+        return sorted({int(round(minimum * ratio ** i)) for i in range(count)})
+
+    def exposure(self, brightness):
+        """Exposure giving brightness (clamped to the calibrated range)"""
+        exposures, brightnesses = self.exposures, self.brightnesses
+        if brightness <= brightnesses[0]:
+            return exposures[0]
+        if brightness >= brightnesses[-1]:
+            # saturated: the shortest exposure reaching the top
+            return exposures[brightnesses.index(brightnesses[-1])]
+        for i in range(1, len(exposures)):
+            if brightnesses[i] >= brightness:
+                low, high = brightnesses[i - 1], brightnesses[i]
+                fraction = (brightness - low) / (high - low)
+                return exposures[i - 1] + fraction * (exposures[i] - exposures[i - 1])
+
+    def slope(self, exposure):
+        """Slope and intercept of the segment containing exposure"""
+        exposures, brightnesses = self.exposures, self.brightnesses
+        i = 1
+        while i < len(exposures) - 1 and exposures[i] < exposure:
+            i += 1
+        slope = (brightnesses[i] - brightnesses[i - 1]) / (exposures[i] - exposures[i - 1])
+        return slope, brightnesses[i] - slope * exposures[i]
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump({
+                "settings": self.settings,
+                "points": list(zip(self.exposures, self.brightnesses)),
+            }, f)
+
+    @classmethod
+    def load(cls, filename, settings=None):
+        """The table saved in filename or None if there is none or it was
+        calibrated with other settings"""
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if settings is not None and data["settings"] != settings:
+            log.info(f"{filename} was calibrated with other settings")
+            return None
+        return cls(data["points"], data["settings"])
+
+
+class WarmStart:
+    """Recent converged (time, exposure, contrast control, brightness)
+    results, to start a search from the one most likely to still be right.
+
+    Results are scored by recency and by how close their time of day is to
+    now (the light at 9:00 yesterday is a better guess for 9:00 today than the
+    light at 17:00). The store is saved to filename after every result"""
+
+    DAY = 24 * 3600
+
+    def __init__(self, filename=None, size=64, half_life=3600,
+                 time_of_day_width=3600, days_half_life=7 * 24 * 3600):
+        self.filename = filename
+        self.size = size
+        self.half_life = half_life
+        self.time_of_day_width = time_of_day_width
+        self.days_half_life = days_half_life
+        self.results = []
+        if filename:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self.results = json.load(f)[-self.size:]
+        except (OSError, ValueError):
+            self.results = []
+
+    def save(self):
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.results, f)
+        os.replace(tmp, self.filename)
+
+    def record(self, exposure, contrast_control, brightness, when=None):
+        self.results.append({
+            "time": time.time() if when is None else when,
+            "exposure": exposure,
+            "contrast_control": contrast_control,
+            "brightness": brightness,
+        })
+        del self.results[:-self.size]
+        if self.filename:
+            try:
+                self.save()
+            except OSError as e:
+                log.error(f"Failed to save {self.filename}: {e}")
+
+    def score(self, result, now):
+        age = max(now - result["time"], 0)
+        recency = 0.5 ** (age / self.half_life)
+        # circular distance between the times of day
+        offset = age % self.DAY
+        offset = min(offset, self.DAY - offset)
+        time_of_day = math.exp(-(offset / self.time_of_day_width) ** 2)
+        return recency + time_of_day * 0.5 ** (age / self.days_half_life)
+
+    def suggest(self, now=None):
+        """The best result to start from or None if there are none"""
+        if not self.results:
+            return None
+        now = time.time() if now is None else now
+        return max(self.results, key=lambda result: self.score(result, now))
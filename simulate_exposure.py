@@ -0,0 +1,87 @@
+"""Compare the exposure controllers on a simulated camera.
+
+    python simulate_exposure.py --scenes 200
+
+The camera has a linear response with a soft knee towards saturation, a
+black level and measurement noise. Each scene draws a random scene
+brightness and starting exposure and counts the captures every controller
+needs to get within the tolerance (giving up after max_attempts, like
+optimise()).
+"""
+import random
+import typer
+import numpy
+from exposure import ModelController, StepController
+
+
+class Camera:
+
+    def __init__(self, gain, black=4, white=250, knee=0.7, noise=0.5, rng=random):
+        self.gain = gain
+        self.black = black
+        self.white = white
+        self.knee = knee
+        self.noise = noise
+        self.rng = rng
+
+    def brightness(self, exposure):
+        linear = self.black + self.gain * exposure
+        knee = self.knee * self.white
+        if linear > knee:
+            # compress the highlights towards white
+            over = (linear - knee) / (self.white - knee)
+            linear = knee + (self.white - knee) * (1 - numpy.exp(-over))
+        return linear + self.rng.gauss(0, self.noise)
+
+
+def attempts(controller, camera, exposure, max_attempts):
+    controller.begin()
+    for count in range(1, max_attempts + 1):
+        brightness = camera.brightness(exposure)
+        if abs(controller.target - brightness) <= controller.tolerance:
+            return count
+        exposure = controller.update(exposure, brightness)
+    return max_attempts
+
+
+def main(scenes: int = 200,
+         target: float = 37,
+         tolerance: float = 2,
+         minimum: int = 25,
+         maximum: int = 1000,
+         step: int = 25,
+         max_attempts: int = 50,
+         seed: int = 0):
+    rng = random.Random(seed)
+    model = ModelController(target, tolerance, minimum, maximum)
+    controllers = {
+        "step": StepController(target, tolerance, minimum, maximum, step),
+        # calibrated once on the first scene like calc_optimal_exposure,
+        # then carried over from scene to scene like in the app
+        "model": model,
+        # the model without any calibration
+        "model (cold)": None,
+    }
+    counts = {name: [] for name in controllers}
+    for i in range(scenes):
+        # brightness reaches the target somewhere in the exposure range
+        camera = Camera(gain=target / rng.uniform(minimum * 2, maximum * 0.8), rng=rng)
+        if i == 0:
+            low, high = camera.brightness(minimum), camera.brightness(maximum)
+            slope = (high - low) / (maximum - minimum)
+            model.calibrate(slope, high - slope * maximum)
+        start = rng.randrange(minimum, maximum, step)
+        for name, controller in controllers.items():
+            if controller is None:
+                controller = ModelController(target, tolerance, minimum, maximum)
+            counts[name].append(attempts(controller, camera, start, max_attempts))
+    print(f"{'controller':<14} {'mean':>6} {'median':>6} {'p95':>6} {'max':>6} {'failed':>6}")
+    for name, values in counts.items():
+        values = numpy.array(values)
+        print(f"{name:<14} {values.mean():6.1f} {numpy.median(values):6.0f} "
+              f"{numpy.percentile(values, 95):6.0f} {values.max():6d} "
+              f"{(values >= max_attempts).sum():6d}")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,277 @@
+import os
+import time
+import queue
+import re
+import logging
+import threading
+import collections
+from concurrent.futures import Future
+
+log = logging.getLogger(__name__)
+
+# fsync policies: "none" only renames, "file" syncs the data before the
+# rename and "dir" also syncs the directory so the rename itself is durable
+FSYNC_POLICIES = ("none", "file", "dir")
+
+# Names Writer.reserve() gives to timestamp named files: <name>[-<n>].jpg
+CAPTURE_PATTERN = r"\d+(-\d+)?\.jpg"
+
+
+class Writer:
+    """Write files in a background thread so the caller doesn't wait for the
+    (SD card) storage.
+
+    Files are written under a temporary name, synced according to the fsync
+    policy and renamed to their final name, so a file at the final path is
+    always complete. The queue is bounded: when it is full submit() blocks,
+    which keeps memory in check if the storage can't keep up"""
+
+    def __init__(self, maxsize=8, fsync="file", history=256, on_write=None):
+        assert fsync in FSYNC_POLICIES, f"fsync must be one of {FSYNC_POLICIES}"
+        self.fsync = fsync
+        # called with the path and size of every file written
+        self.on_write = on_write
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        # path: Future of the files submitted recently
+        self._files = {}
+        self._history = history
+        self._thread = threading.Thread(target=self._run, name="storage", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def reserve(self, directory, name, suffix=".jpg"):
+        """A path in directory which is not used by an existing or pending
+        file: name + suffix or name-<n> + suffix"""
+        with self._lock:
+            path = os.path.join(directory, f"{name}{suffix}")
+            n = 0
+            while path in self._files or os.path.exists(path):
+                n += 1
+                path = os.path.join(directory, f"{name}-{n}{suffix}")
+            future = Future()
+            future.set_running_or_notify_cancel()
+            self._files[path] = future
+            # forget the oldest files which are done
+            excess = len(self._files) - self._history
+            if excess > 0:
+                done = [p for p, f in self._files.items() if f.done()]
+                for old in done[:excess]:
+                    del self._files[old]
+        return path
+
+    def submit(self, path, data, on_write=None):
+        """Queue data to be written to path (see reserve). Returns a Future
+        with the path once the file is written and synced. on_write is called
+        with the path and size once it is, before the writer's on_write"""
+        with self._lock:
+            future = self._files.get(path)
+            if future is None:
+                future = self._files[path] = Future()
+                future.set_running_or_notify_cancel()
+        self._queue.put((path, data, future, on_write))
+        return future
+
+    def status(self, path):
+        """"pending", "durable" ("written" if it isn't synced), "failed" or
+        None if path is not known"""
+        with self._lock:
+            future = self._files.get(path)
+        if future is None:
+            return None
+        if not future.done():
+            return "pending"
+        if future.exception():
+            return "failed"
+        return "written" if self.fsync == "none" else "durable"
+
+    def wait(self, path, timeout=None):
+        """Wait until path is written (and synced). Raises the error if writing
+        it failed"""
+        with self._lock:
+            future = self._files[path]
+        return future.result(timeout)
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def _write(self, path, data):
+        directory, name = os.path.split(path)
+        tmppath = os.path.join(directory, f".{name}.tmp")
+        try:
+            with open(tmppath, "wb") as f:
+                f.write(data)
+                if self.fsync != "none":
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(tmppath, path)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+        if self.fsync == "dir":
+            fd = os.open(directory or ".", os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            path, data, future, on_write = item
+            try:
+                self._write(path, data)
+            except Exception as e:
+                log.error(f"Failed to write {path}: {e}")
+                future.set_exception(e)
+                continue
+            for callback in (on_write, self.on_write):
+                if callback is None:
+                    continue
+                try:
+                    callback(path, len(data))
+                except Exception as e:
+                    log.error(f"Failed to record {path}: {e}")
+            future.set_result(path)
+
+    def close(self):
+        """Write what is queued and stop the thread"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+class Retention:
+    """Keep the files of a directory within a total size, an age and a count
+    by deleting the oldest ones.
+
+    The directory is scanned once, then the index is kept up to date with
+    add() so pruning never has to list the directory again. Pruning runs in a
+    background thread, a few files at a time so it never holds the storage
+    for long. Limits of None (or 0) are not enforced"""
+
+    def __init__(self, directory, max_bytes=None, max_age=None, max_count=None,
+                 pattern=CAPTURE_PATTERN, batch=16, interval=60.0, on_remove=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_count = max_count
+        # regular expression the names of the files we manage match: the
+        # directory may hold other files (eg. /tmp)
+        self.pattern = re.compile(pattern)
+        self.batch = batch
+        self.interval = interval
+        # called with the paths of the files removed by each prune
+        self.on_remove = on_remove
+        self.removed = 0
+        self._lock = threading.Lock()
+        # path: (mtime, size), oldest first
+        self._index = collections.OrderedDict()
+        self.bytes = 0
+        self._scan()
+        self._wakeup = threading.Event()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _scan(self):
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and self.pattern.fullmatch(entry.name):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+        for mtime, path, size in sorted(files):
+            self._index[path] = mtime, size
+            self.bytes += size
+
+    def add(self, path, size, mtime=None):
+        """Record a new file (the newest)"""
+        if mtime is None:
+            mtime = time.time()
+        with self._lock:
+            old = self._index.pop(path, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._index[path] = mtime, size
+            self.bytes += size
+            over = self._over(time.time())
+        if over:
+            self._wakeup.set()
+
+    @property
+    def count(self):
+        return len(self._index)
+
+    def stats(self):
+        with self._lock:
+            oldest = next(iter(self._index.values()), (None,))[0]
+            return {
+                "count": len(self._index),
+                "bytes": self.bytes,
+                "oldest": oldest,
+                "removed": self.removed,
+            }
+
+    def _over(self, now):
+        if not self._index:
+            return False
+        if self.max_count and len(self._index) > self.max_count:
+            return True
+        if self.max_bytes and self.bytes > self.max_bytes:
+            return True
+        if self.max_age:
+            mtime, _ = next(iter(self._index.values()))
+            return now - mtime > self.max_age
+        return False
+
+    def prune(self, batch=None):
+        """Delete up to batch of the oldest files while over a limit. Returns
+        the number of files removed"""
+        batch = batch or self.batch
+        now = time.time()
+        paths = []
+        with self._lock:
+            while len(paths) < batch and self._over(now):
+                path, (mtime, size) = self._index.popitem(last=False)
+                self.bytes -= size
+                paths.append(path)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.error(f"Failed to remove {path}: {e}")
+        self.removed += len(paths)
+        if paths and self.on_remove is not None:
+            self.on_remove(paths)
+        return len(paths)
+
+    def _run(self):
+        while not self._stop:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            # a batch at a time, letting the writer in between batches
+            while not self._stop and self.prune() == self.batch:
+                time.sleep(0.01)
+
+    def close(self):
+        self._stop = True
+        self._wakeup.set()
+        self._thread.join()
@@ -0,0 +1,58 @@
+import pytest
+
+from capture_index import CaptureIndex
+
+
+@pytest.fixture
+def index(tmp_path):
+    with CaptureIndex(str(tmp_path / "captures.db")) as index:
+        yield index
+
+
+def paths(rows):
+    return [row["path"] for row in rows]
+
+
+def test_query_newest_first(index):
+    for n in range(3):
+        index.add(f"{n}.jpg", 100, captured_at=1000 + n, exposure=100 + n)
+    rows = index.query()
+    assert paths(rows) == ["2.jpg", "1.jpg", "0.jpg"]
+    assert rows[0]["exposure"] == 102
+    assert rows[0]["size"] == 100
+    assert rows[0]["brightness"] is None
+    assert paths(index.query(limit=1)) == ["2.jpg"]
+
+
+def test_query_time_range(index):
+    for n in range(4):
+        index.add(f"{n}.jpg", 100, captured_at=1000 + n)
+    assert paths(index.query(since=1001, until=1003)) == ["2.jpg", "1.jpg"]
+
+
+def test_query_metric_ranges(index):
+    for n, brightness in enumerate((20, 35, 50)):
+        index.add(f"{n}.jpg", 100, captured_at=1000 + n, brightness=brightness)
+    assert paths(index.query(min_brightness=30, max_brightness=50)) == ["2.jpg", "1.jpg"]
+
+
+@pytest.mark.parametrize("key", ["min_path", "max_unknown", "between_brightness"])
+def test_query_unknown_filter(index, key):
+    with pytest.raises(ValueError):
+        index.query(**{key: 1})
+
+
+def test_removed(index):
+    index.add("0.jpg", 100, captured_at=1000)
+    index.add("1.jpg", 100, captured_at=1001)
+    index.removed(["0.jpg"])
+    assert paths(index.query()) == ["1.jpg"]
+    assert paths(index.query(removed=True)) == ["1.jpg", "0.jpg"]
+
+
+def test_path_reused_after_removal(index):
+    index.add("0.jpg", 100, captured_at=1000)
+    index.removed(["0.jpg"])
+    # a new capture stored under the name of a removed one
+    index.add("0.jpg", 100, captured_at=2000)
+    assert [row["captured_at"] for row in index.query()] == [2000]
@@ -0,0 +1,43 @@
+import errno
+import collections
+from types import SimpleNamespace
+
+import pytest
+
+from v4l2py import raw
+from v4l2py.device import VideoStream
+
+
+def make_frame(flags=0):
+    return SimpleNamespace(flags=flags, format=None, sequence=0)
+
+
+def make_stream(frames, max_dropped=32):
+    stream = VideoStream.__new__(VideoStream)
+    frames = iter(frames)
+    stream.buffers = SimpleNamespace(
+        read=lambda: next(frames), raw_read=lambda: next(frames))
+    stream.validate = True
+    stream.max_dropped = max_dropped
+    stream.stats = collections.Counter()
+    return stream
+
+
+def test_read_skips_flagged_frames():
+    good = make_frame()
+    stream = make_stream([make_frame(raw.V4L2_BUF_FLAG_ERROR)] * 3 + [good])
+    assert stream.read() is good
+    assert stream.stats == {"errors": 3, "frames": 1}
+
+
+def test_read_gives_up():
+    stream = make_stream([make_frame(raw.V4L2_BUF_FLAG_ERROR)] * 100, max_dropped=4)
+    with pytest.raises(OSError) as info:
+        stream.read()
+    assert info.value.errno == errno.EIO
+    assert stream.stats["errors"] == 5
+
+
+def test_raw_read_drops():
+    stream = make_stream([make_frame(raw.V4L2_BUF_FLAG_ERROR)])
+    assert stream.raw_read() is None
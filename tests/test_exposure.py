@@ -0,0 +1,174 @@
+import json
+
+import pytest
+
+from exposure import (
+    StepController, ModelController, CalibrationTable, WarmStart, monotone,
+)
+
+
+def scene(slope=0.12, black=4, saturation=255):
+    return lambda exposure: min(saturation, black + slope * exposure)
+
+
+def search(controller, scene, exposure, attempts=20):
+    controller.begin()
+    for count in range(1, attempts + 1):
+        new = controller.update(exposure, scene(exposure))
+        if new == exposure:
+            return exposure, count
+        exposure = new
+    return exposure, None
+
+
+def test_step_controller():
+    controller = StepController(100, 5, 10, 1000, step=25)
+    assert controller.update(500, 80) == 525
+    assert controller.update(500, 120) == 475
+    assert controller.update(500, 103) == 500
+    assert controller.update(990, 20) == 1000
+    assert controller.update(20, 200) == 10
+
+
+@pytest.mark.parametrize("start", [25, 300, 1000])
+def test_model_converges(start):
+    controller = ModelController(37, 2, 25, 1000, black=4)
+    exposure, attempts = search(controller, scene(), start)
+    assert abs(scene()(exposure) - 37) <= 2
+    assert attempts <= 5
+
+
+def test_model_within_tolerance():
+    controller = ModelController(37, 2, 25, 1000)
+    assert controller.update(300, 38) == 300
+
+
+def test_model_black_frame_goes_far():
+    controller = ModelController(37, 2, 25, 1000, max_change=1)
+    # no slope from a black frame at black level 0
+    assert controller.update(100, 0) == 1000
+
+
+def test_model_max_change():
+    controller = ModelController(200, 2, 0, 1000, black=0, max_change=0.1)
+    # the model wants 2000, limited to 10% of the range
+    assert controller.update(100, 10) == 200
+
+
+def test_model_clamped():
+    controller = ModelController(37, 2, 25, 1000, black=0, damping=1, max_change=1)
+    assert controller.update(100, 200) == 25
+    controller.begin()
+    assert controller.update(900, 20) == 1000
+
+
+def test_model_keeps_slope_when_saturated():
+    controller = ModelController(37, 2, 25, 1000, black=0)
+    controller.update(100, 20)
+    slope = controller.slope
+    # brighter exposure, same (saturated) brightness: flat secant
+    controller.update(200, 20)
+    assert controller.slope == slope
+
+
+def test_model_resolution():
+    controller = ModelController(37, 1, 0, 1000, resolution=10, black=0)
+    exposure = controller.update(100, 30)
+    assert exposure % 10 == 0
+    # a change smaller than the resolution still moves by one step
+    controller.begin()
+    assert controller.update(100, 35.8) == 110
+
+
+def test_model_calibrate():
+    controller = ModelController(37, 2, 25, 1000)
+    controller.calibrate(0.12, 4)
+    assert controller.predict(37) == pytest.approx(275)
+    controller.calibrate(-1, 0)
+    assert controller.slope == 0.12
+
+
+DAY = 24 * 3600
+
+
+def test_warm_start_empty(tmp_path):
+    assert WarmStart().suggest() is None
+    assert WarmStart(str(tmp_path / "missing.json")).suggest() is None
+
+
+def test_warm_start_most_recent():
+    warm = WarmStart()
+    warm.record(100, 32, 37, when=1000)
+    warm.record(200, 32, 37, when=2000)
+    assert warm.suggest(now=2100)["exposure"] == 200
+
+
+def test_warm_start_time_of_day():
+    warm = WarmStart(half_life=600)
+    now = 10 * DAY + 9 * 3600
+    # yesterday at the same time vs this morning, hours ago
+    warm.record(100, 32, 37, when=now - DAY)
+    warm.record(200, 32, 37, when=now - 5 * 3600)
+    assert warm.suggest(now=now)["exposure"] == 100
+
+
+def test_warm_start_persisted(tmp_path):
+    filename = str(tmp_path / "warm.json")
+    warm = WarmStart(filename, size=2)
+    for exposure in (100, 200, 300):
+        warm.record(exposure, 32, 37, when=exposure)
+    assert [r["exposure"] for r in json.load(open(filename))] == [200, 300]
+    assert WarmStart(filename).suggest(now=300)["exposure"] == 300
+
+
+def test_warm_start_corrupt_file(tmp_path):
+    filename = tmp_path / "warm.json"
+    filename.write_text("{not json")
+    assert WarmStart(str(filename)).suggest() is None
+
+
+def test_monotone():
+    assert monotone([1, 3, 2, 4]) == [1, 2.5, 2.5, 4]
+    assert monotone([3, 2, 1]) == [2, 2, 2]
+    assert monotone([]) == []
+
+
+def test_exposures_between():
+    exposures = CalibrationTable.exposures_between(25, 1000, 5)
+    assert exposures[0] == 25 and exposures[-1] == 1000
+    assert exposures == sorted(set(exposures))
+    # denser at short exposures
+    assert exposures[1] - exposures[0] < exposures[-1] - exposures[-2]
+    assert len(CalibrationTable.exposures_between(25, 1000, 1)) == 2
+
+
+def test_table_exposure():
+    table = CalibrationTable([(100, 10), (300, 50), (200, 30)])
+    assert table.exposures == [100, 200, 300]
+    assert table.exposure(40) == pytest.approx(250)
+    assert table.exposure(5) == 100
+    assert table.exposure(80) == 300
+
+
+def test_table_saturated():
+    table = CalibrationTable([(100, 100), (200, 255), (300, 255)])
+    assert table.exposure(255) == 200
+
+
+def test_table_slope():
+    table = CalibrationTable([(100, 10), (200, 30), (300, 70)])
+    assert table.slope(150) == pytest.approx((0.2, -10))
+    assert table.slope(250) == pytest.approx((0.4, -50))
+    # beyond the ends: the end segments
+    assert table.slope(50) == pytest.approx((0.2, -10))
+    assert table.slope(1000) == pytest.approx((0.4, -50))
+
+
+def test_table_saved(tmp_path):
+    filename = str(tmp_path / "calibration.json")
+    settings = {"exposure_min": 25, "exposure_max": 1000}
+    CalibrationTable([(100, 10), (200, 30)], settings).save(filename)
+    table = CalibrationTable.load(filename, settings)
+    assert table.exposure(20) == pytest.approx(150)
+    assert CalibrationTable.load(filename, {"exposure_min": 50}) is None
+    assert CalibrationTable.load(str(tmp_path / "missing.json")) is None
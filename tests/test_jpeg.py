@@ -0,0 +1,113 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from v4l2py import jpeg
+
+
+def make_jpeg(width=64, height=48, mode="RGB", **kwargs):
+    data = BytesIO()
+    Image.new(mode, (width, height), 128).save(data, "JPEG", **kwargs)
+    return data.getvalue()
+
+
+def test_check_valid():
+    jpeg.check(make_jpeg())
+    assert jpeg.is_valid(make_jpeg())
+
+
+@pytest.mark.parametrize("padding", [0, 1, jpeg.TAIL_SIZE, jpeg.TAIL_SIZE + 1, 5000])
+def test_check_zero_padding(padding):
+    assert jpeg.is_valid(make_jpeg() + b"\0" * padding)
+
+
+@pytest.mark.parametrize("padding", [0, 2000])
+def test_check_missing_eoi(padding):
+    data = make_jpeg()[:-2] + b"\0" * padding
+    with pytest.raises(jpeg.JpegError, match="EOI"):
+        jpeg.check(data)
+
+
+def test_check_eoi_split_across_padding_chunks():
+    data = make_jpeg()[:-2] + b"\xff" + b"\0" * jpeg.TAIL_SIZE + b"\xd9"
+    assert not jpeg.is_valid(data)
+
+
+def test_check_truncated():
+    data = make_jpeg()
+    assert not jpeg.is_valid(data[:jpeg.MIN_SIZE - 1])
+    # cut in the middle of the headers
+    assert not jpeg.is_valid(data[:100])
+
+
+def test_check_no_soi():
+    with pytest.raises(jpeg.JpegError, match="SOI"):
+        jpeg.check(b"\0" * 100)
+
+
+def test_check_sos_without_sof():
+    sos = b"\xff\xda\x00\x08\x01\x01\x00\x00\x3f\x00"
+    with pytest.raises(jpeg.JpegError, match="SOS without SOF"):
+        jpeg.check(jpeg.SOI + sos + b"\0" * 20 + jpeg.EOI)
+
+
+@pytest.mark.parametrize("subsampling, mcu", [(0, (8, 8)), (1, (16, 8)), (2, (16, 16))])
+def test_parse_header(subsampling, mcu):
+    header = jpeg.parse_header(make_jpeg(100, 60, subsampling=subsampling))
+    assert (header.width, header.height) == (100, 60)
+    assert len(header.components) == 3
+    assert (header.mcu_width, header.mcu_height) == mcu
+    assert header.restart_interval == 0
+
+
+def test_parse_header_grey():
+    header = jpeg.parse_header(make_jpeg(mode="L"))
+    assert len(header.components) == 1
+    assert (header.mcu_width, header.mcu_height) == (8, 8)
+
+
+def test_parse_header_restart_interval():
+    data = make_jpeg()
+    # DRI segments are only found in the headers, after APP0 will do
+    data = jpeg.insert_segment(data, jpeg.DRI, b"\x00\x04")
+    assert jpeg.parse_header(data).restart_interval == 4
+
+
+def test_insert_segment_after_app0():
+    data = make_jpeg()
+    payload = b"hello"
+    result = jpeg.insert_segment(data, jpeg.APP1, payload)
+    assert len(result) == len(data) + 4 + len(payload)
+    markers = [marker for marker, _, _ in jpeg.segments(result)]
+    assert markers[:2] == [jpeg.APP0, jpeg.APP1]
+    jpeg.check(result)
+    # the entropy coded data is untouched
+    assert result.endswith(data[-100:])
+
+
+def test_insert_segment_too_long():
+    with pytest.raises(jpeg.JpegError, match="too long"):
+        jpeg.insert_segment(make_jpeg(), jpeg.APP1, b"\0" * 0xFFFF)
+
+
+def test_exif():
+    from datetime import datetime
+    description = '{"exposure": 156, "brightness": 37.5}'
+    data = jpeg.insert_segment(make_jpeg(), jpeg.APP1, jpeg.exif(
+        description, datetime(2022, 1, 2, 3, 4, 5), "accumen_camera"))
+    image = Image.open(BytesIO(data))
+    exif = image.getexif()
+    assert exif[jpeg.TAG_IMAGE_DESCRIPTION] == description
+    assert exif[jpeg.TAG_DATE_TIME] == "2022:01:02 03:04:05"
+    assert exif[jpeg.TAG_SOFTWARE] == "accumen_camera"
+    image.load()
+
+
+@pytest.mark.parametrize("description", ["", "a", "abc", "abcd"])
+def test_exif_short_values(description):
+    # values of up to 4 bytes (with the NUL) are stored in the entry itself
+    data = jpeg.insert_segment(make_jpeg(), jpeg.APP1, jpeg.exif(description))
+    exif = Image.open(BytesIO(data)).getexif()
+    assert exif[jpeg.TAG_IMAGE_DESCRIPTION] == description
+    assert jpeg.TAG_DATE_TIME not in exif
@@ -0,0 +1,132 @@
+import os
+import time
+import threading
+
+import pytest
+
+from storage import Writer, Retention
+
+
+@pytest.fixture
+def writer():
+    writer = Writer(fsync="file")
+    yield writer
+    writer.close()
+
+
+def test_reserve_unique(tmp_path, writer):
+    (tmp_path / "100.jpg").write_bytes(b"old")
+    first = writer.reserve(str(tmp_path), 100)
+    second = writer.reserve(str(tmp_path), 100)
+    assert os.path.basename(first) == "100-1.jpg"
+    assert os.path.basename(second) == "100-2.jpg"
+    assert writer.status(first) == "pending"
+
+
+def test_submit(tmp_path, writer):
+    path = writer.reserve(str(tmp_path), 100)
+    assert writer.submit(path, b"data").result(5) == path
+    assert writer.status(path) == "durable"
+    assert open(path, "rb").read() == b"data"
+    # no temporary file left behind
+    assert os.listdir(tmp_path) == ["100.jpg"]
+
+
+def test_status_unsynced(tmp_path):
+    with Writer(fsync="none") as writer:
+        path = writer.reserve(str(tmp_path), 100)
+        writer.wait(writer.submit(path, b"data").result(5))
+        assert writer.status(path) == "written"
+
+
+def test_status_unknown(writer):
+    assert writer.status("/nowhere.jpg") is None
+
+
+def test_failed_write(tmp_path, writer):
+    path = str(tmp_path / "missing" / "100.jpg")
+    future = writer.submit(path, b"data")
+    with pytest.raises(OSError):
+        future.result(5)
+    assert writer.status(path) == "failed"
+    with pytest.raises(OSError):
+        writer.wait(path)
+
+
+def test_on_write_order(tmp_path):
+    calls = []
+    with Writer(on_write=lambda path, size: calls.append(("writer", size))) as writer:
+        path = writer.reserve(str(tmp_path), 100)
+        future = writer.submit(
+            path, b"data", on_write=lambda path, size: calls.append(("file", size)))
+        future.result(5)
+    # the file is recorded (indexed) before the writer's on_write (retention)
+    assert calls == [("file", 4), ("writer", 4)]
+
+
+def test_on_write_error_doesnt_fail_the_write(tmp_path, writer):
+    path = writer.reserve(str(tmp_path), 100)
+
+    def broken(path, size):
+        raise RuntimeError("index is down")
+
+    assert writer.submit(path, b"data", on_write=broken).result(5) == path
+
+
+def make_files(directory, names, size=10):
+    now = time.time()
+    for age, name in enumerate(reversed(names)):
+        path = directory / name
+        path.write_bytes(b"x" * size)
+        os.utime(path, (now - age * 60, now - age * 60))
+
+
+def test_retention_scan_pattern(tmp_path):
+    make_files(tmp_path, ["100.jpg", "101-1.jpg", "holiday.jpg", "2023-photo.jpg", ".102.jpg.tmp"])
+    with Retention(str(tmp_path)) as retention:
+        assert retention.stats()["count"] == 2
+        assert retention.bytes == 20
+
+
+def test_retention_max_count(tmp_path):
+    removed = []
+    make_files(tmp_path, ["100.jpg", "101.jpg", "102.jpg", "other.jpg"])
+    with Retention(str(tmp_path), max_count=1, on_remove=removed.extend) as retention:
+        assert retention.prune() == 2
+        assert sorted(os.listdir(tmp_path)) == ["102.jpg", "other.jpg"]
+        assert [os.path.basename(path) for path in removed] == ["100.jpg", "101.jpg"]
+        assert retention.stats()["removed"] == 2
+
+
+def test_retention_max_bytes(tmp_path):
+    make_files(tmp_path, ["100.jpg", "101.jpg", "102.jpg"])
+    with Retention(str(tmp_path), max_bytes=25) as retention:
+        retention.prune()
+        assert sorted(os.listdir(tmp_path)) == ["101.jpg", "102.jpg"]
+
+
+def test_retention_max_age(tmp_path):
+    make_files(tmp_path, ["100.jpg", "101.jpg", "102.jpg"])
+    with Retention(str(tmp_path), max_age=90) as retention:
+        retention.prune()
+        # 120s and 60s old: only the first is over
+        assert sorted(os.listdir(tmp_path)) == ["101.jpg", "102.jpg"]
+
+
+def test_retention_batch(tmp_path):
+    make_files(tmp_path, [f"{n}.jpg" for n in range(100, 110)])
+    with Retention(str(tmp_path), max_count=1, batch=4) as retention:
+        assert retention.prune() == 4
+        assert retention.count == 6
+
+
+def test_retention_add_prunes_in_background(tmp_path):
+    done = threading.Event()
+    with Retention(str(tmp_path), max_count=1,
+                   on_remove=lambda paths: done.set()) as retention:
+        for n in (100, 101):
+            path = tmp_path / f"{n}.jpg"
+            path.write_bytes(b"x")
+            retention.add(str(path), 1)
+        assert done.wait(5)
+        assert os.listdir(tmp_path) == ["101.jpg"]
@@ -7,13 +7,23 @@
 import os
 import enum
 import mmap
+import time
 import errno
 import fcntl
 import select
+import logging
 import pathlib
 import collections
+import concurrent.futures
 
 from . import raw
+from . import jpeg
+
+
+log = logging.getLogger(__name__)
+
+# errors reported by the driver once the device has been unplugged
+DISCONNECT_ERRNOS = {errno.ENODEV, errno.ENXIO, errno.EIO}
 
 
 def _enum(name, prefix, klass=enum.IntEnum):
@@ -30,8 +40,23 @@ ImageFormatFlag = _enum("ImageFormatFlag", "V4L2_FMT_FLAG_", klass=enum.IntFlag)
 Field = _enum("Field", "V4L2_FIELD_")
 FrameSizeType = _enum("FrameSizeType", "V4L2_FRMSIZE_TYPE_")
 FrameIntervalType = _enum("FrameIntervalType", "V4L2_FRMIVAL_TYPE_")
+SelectionTarget = _enum("SelectionTarget", "V4L2_SEL_TGT_")
+SelectionFlag = _enum("SelectionFlag", "V4L2_SEL_FLAG_", klass=enum.IntFlag)
+CtrlFlag = _enum("CtrlFlag", "V4L2_CTRL_FLAG_", klass=enum.IntFlag)
+EventType = enum.IntEnum("EventType", [
+    (name, getattr(raw, "V4L2_EVENT_" + name)) for name in
+    ("ALL", "VSYNC", "EOS", "CTRL", "FRAME_SYNC", "SOURCE_CHANGE", "MOTION_DET")])
+EventSubscriptionFlag = _enum("EventSubscriptionFlag", "V4L2_EVENT_SUB_FL_", klass=enum.IntFlag)
+EventControlChange = _enum("EventControlChange", "V4L2_EVENT_CTRL_CH_", klass=enum.IntFlag)
+EventSourceChange = _enum("EventSourceChange", "V4L2_EVENT_SRC_CH_", klass=enum.IntFlag)
 IOC = _enum("IOC", "VIDIOC_", klass=enum.Enum)
 
+# formats whose frames are checked with jpeg.check
+JPEG_FORMATS = {PixelFormat.MJPEG, PixelFormat.JPEG}
+
+
+Node = collections.namedtuple(
+    "Node", "filename driver card bus_info capabilities")
 
 Info = collections.namedtuple(
     "Info", "driver card bus_info version physical_capabilities capabilities crop_capabilities buffers formats frame_sizes")
@@ -39,15 +64,28 @@ Info = collections.namedtuple(
 ImageFormat = collections.namedtuple(
     "ImageFormat", "type description flags pixel_format")
 
-Format = collections.namedtuple("Format", "width height pixel_format")
+Format = collections.namedtuple(
+    "Format", "width height pixel_format bytesperline size")
 
 CropCapability = collections.namedtuple(
     "CropCapability", "type bounds defrect pixel_aspect")
 
 Rect = collections.namedtuple("Rect", "left top width height")
 
+Control = collections.namedtuple(
+    "Control", "id type name minimum maximum step default flags")
+
 Size = collections.namedtuple("Size", "width height")
 
+Mode = collections.namedtuple(
+    "Mode", "width height pixel_format fps skip", defaults=("MJPG", None, 0))
+
+Event = collections.namedtuple(
+    "Event", "type id sequence pending timestamp data")
+
+ControlEvent = collections.namedtuple(
+    "ControlEvent", "changes type value flags minimum maximum step default")
+
 FrameType = collections.namedtuple(
     "FrameType", "type pixel_format width height min_fps max_fps step_fps")
 
@@ -169,14 +207,72 @@ def read_info(fd):
     )
 
 
+def _query_node(fd, filename):
+    caps = raw.v4l2_capability()
+    fcntl.ioctl(fd, IOC.QUERYCAP.value, caps)
+    return Node(
+        filename=filename,
+        driver=caps.driver.decode(),
+        card=caps.card.decode(),
+        bus_info=caps.bus_info.decode(),
+        capabilities=Capability(caps.device_caps),
+    )
+
+
+def query_node(filename):
+    """Identify a device node with a single QUERYCAP. The node is closed again
+    before returning. Returns None if the node can't be opened or queried"""
+    try:
+        fd = os.open(filename, os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        return _query_node(fd, filename)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def iter_nodes(path="/dev", workers=None):
+    """Iterate over the Node of every /dev/video* node, optionally querying
+    them concurrently in a pool of workers threads"""
+    files = sorted(pathlib.Path(path).glob("video*"))
+    if workers:
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            nodes = list(pool.map(query_node, files))
+    else:
+        nodes = map(query_node, files)
+    return (node for node in nodes if node is not None)
+
+
+def find_device(bus_info, path="/dev", capabilities=Capability.VIDEO_CAPTURE):
+    """Return the filename of the node with the given bus_info and capabilities
+    or None if there is no such node"""
+    for node in iter_nodes(path):
+        if node.bus_info == bus_info and capabilities in node.capabilities:
+            return node.filename
+
+
 class Device:
 
-    def __init__(self, filename):
+    def __init__(self, filename, recover_timeout=None):
         self._context_level = 0
-        self._fd = os.open(filename, os.O_RDWR | os.O_NONBLOCK)
-        self.info = read_info(self._fd)
-        self.filename = filename
-        if Capability.VIDEO_CAPTURE in self.info.capabilities:
+        self._fd = None
+        self._buffers = None
+        self._recovering = False
+        # set when the device didn't come back in time: the next ioctl tries
+        # to reopen it again
+        self._lost = False
+        self._subscriptions = {}
+        # callables called with every Event dequeued by dispatch_events()
+        self.event_handlers = []
+        # incremented every time the device node is (re)opened
+        self.generation = 0
+        # seconds to wait for an unplugged device to come back (None disables)
+        self.recover_timeout = recover_timeout
+        self._open(filename)
+        if Capability.VIDEO_CAPTURE in self.node.capabilities:
             self.video_capture = VideoCapture(self)
         else:
             self.video_capture = None
@@ -193,14 +289,168 @@ class Device:
     def __iter__(self):
         return iter(self.video_capture)
 
+    def _open(self, filename):
+        self._fd = os.open(filename, os.O_RDWR | os.O_NONBLOCK)
+        try:
+            self.node = _query_node(self._fd, filename)
+        except OSError:
+            self._release()
+            raise
+        self._info = None
+        self.filename = filename
+        self._lost = False
+        self.generation += 1
+
+    @property
+    def info(self):
+        # the full enumeration (formats, frame sizes...) is only done on demand
+        if self._info is None:
+            self._info = read_info(self._fd)
+        return self._info
+
     def _ioctl(self, request, arg=0):
+        if self._fd is None:
+            if not self._lost or self.recover_timeout is None or self._recovering:
+                raise OSError(errno.ENODEV, f"{self.filename} is closed")
+            self.reopen(self.recover_timeout)
+            return fcntl.ioctl(self, request, arg)
+        try:
+            return fcntl.ioctl(self, request, arg)
+        except OSError as error:
+            if self.recover_timeout is None or self._recovering or \
+               error.errno not in DISCONNECT_ERRNOS:
+                raise
+            log.warning("%s disconnected (%s), recovering", self.filename, error)
+        self.reopen(self.recover_timeout)
         return fcntl.ioctl(self, request, arg)
 
     @classmethod
-    def from_id(self, did):
-        return Device("/dev/video{}".format(did))
+    def from_id(self, did, **kwargs):
+        return Device("/dev/video{}".format(did), **kwargs)
+
+    def reopen(self, timeout=None, interval=0.1):
+        """Reopen the device after a disconnect and restore its format, controls,
+        buffers and streaming state. The device is looked up by bus_info since
+        it may come back under a different node. Raises OSError(ENODEV) if it
+        doesn't come back within timeout seconds"""
+        bus_info = self.node.bus_info
+        path = pathlib.Path(self.filename).parent
+        start = time.monotonic()
+        self._recovering = True
+        try:
+            while True:
+                self._release()
+                try:
+                    filename = find_device(bus_info, path) or self.filename
+                    self._open(filename)
+                    for args in self._subscriptions.values():
+                        self.subscribe_event(*args)
+                    if self.video_capture is not None:
+                        self.video_capture.restore()
+                    log.info("%s recovered as %s in %.3fs", bus_info, filename,
+                             time.monotonic() - start)
+                    return
+                except OSError as error:
+                    log.debug("%s not back yet: %s", bus_info, error)
+                if timeout is not None and time.monotonic() - start > timeout:
+                    self._release()
+                    self._lost = True
+                    raise OSError(errno.ENODEV, f"{bus_info} did not come back after {timeout}s")
+                time.sleep(interval)
+        finally:
+            self._recovering = False
+
+    def subscribe_event(self, type, id=0, flags=0):
+        """Subscribe to events of the given type (for CTRL events id is the
+        control id). Events are signalled with POLLPRI on the device"""
+        sub = raw.v4l2_event_subscription()
+        sub.type = type
+        sub.id = id
+        sub.flags = flags
+        self._ioctl(IOC.SUBSCRIBE_EVENT.value, sub)
+        self._subscriptions[(type, id)] = type, id, flags
+
+    def unsubscribe_event(self, type=EventType.ALL, id=0):
+        sub = raw.v4l2_event_subscription()
+        sub.type = type
+        sub.id = id
+        self._ioctl(IOC.UNSUBSCRIBE_EVENT.value, sub)
+        if type == EventType.ALL:
+            self._subscriptions.clear()
+        else:
+            self._subscriptions.pop((type, id), None)
+
+    @property
+    def subscribed(self):
+        return bool(self._subscriptions)
+
+    def dequeue_event(self):
+        """Return the next pending Event or None if there isn't any"""
+        ev = raw.v4l2_event()
+        try:
+            self._ioctl(IOC.DQEVENT.value, ev)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return None
+            raise
+        if ev.type == EventType.CTRL:
+            ctrl = ev.u.ctrl
+            data = ControlEvent(
+                changes=EventControlChange(ctrl.changes), type=ctrl.type,
+                value=ctrl.value64 if ctrl.type == raw.V4L2_CTRL_TYPE_INTEGER64 else ctrl.value,
+                flags=CtrlFlag(ctrl.flags), minimum=ctrl.minimum,
+                maximum=ctrl.maximum, step=ctrl.step, default=ctrl.default_value)
+        elif ev.type == EventType.SOURCE_CHANGE:
+            data = EventSourceChange(ev.u.src_change.changes)
+        elif ev.type == EventType.FRAME_SYNC:
+            data = ev.u.frame_sync.frame_sequence
+        else:
+            data = bytes(ev.u.data)
+        try:
+            type = EventType(ev.type)
+        except ValueError:
+            # driver private event
+            type = ev.type
+        return Event(
+            type=type, id=ev.id, sequence=ev.sequence, pending=ev.pending,
+            timestamp=ev.timestamp.secs + ev.timestamp.nsecs * 1e-9, data=data)
+
+    def dispatch_events(self):
+        """Dequeue all pending events and hand them to the event handlers.
+        Returns the number of events dispatched"""
+        count = 0
+        while True:
+            event = self.dequeue_event()
+            if event is None:
+                return count
+            count += 1
+            for handler in self.event_handlers:
+                handler(event)
+
+    def iter_events(self):
+        """Wait for and iterate over events, independently of streaming"""
+        while True:
+            select.select((), (), (self,))
+            while True:
+                event = self.dequeue_event()
+                if event is None:
+                    break
+                yield event
+
+    def _release(self):
+        if self._buffers is not None:
+            self._buffers.unmap()
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
 
     def close(self):
+        if self._buffers is not None:
+            self._buffers.unmap()
+            self._buffers = None
         if self._fd is not None:
             os.close(self._fd)
             self._fd = None
@@ -213,11 +463,29 @@ class Device:
         return self._fd is None
 
 
+def get_format(device, buffer_type=BufferType.VIDEO_CAPTURE):
+    f = raw.v4l2_format()
+    f.type = buffer_type
+    device._ioctl(IOC.G_FMT.value, f)
+    return Format(
+        width=f.fmt.pix.width,
+        height=f.fmt.pix.height,
+        pixel_format=PixelFormat(f.fmt.pix.pixelformat),
+        bytesperline=f.fmt.pix.bytesperline,
+        size=f.fmt.pix.sizeimage,
+    )
+
+
 class VideoCapture:
 
     def __init__(self, device, buffer_type=BufferType.VIDEO_CAPTURE):
         self.device = device
         self.buffer_type = buffer_type
+        self._selection_supported = None
+        self._jpeg_quality_method = None
+        # settings applied so far, in order, so they can be replayed on reopen
+        self._settings = collections.OrderedDict()
+        self.streaming = False
 
     def __iter__(self):
         return iter(VideoStream(self))
@@ -225,6 +493,29 @@ class VideoCapture:
     def _ioctl(self, request, arg=0):
         return self.device._ioctl(request.value, arg=arg)
 
+    def _remember(self, key, method, *args):
+        self._settings.pop(key, None)
+        self._settings[key] = method, args
+
+    def restore(self):
+        """Replay the settings, buffers and streaming state after the device
+        has been reopened"""
+        self._selection_supported = None
+        self._jpeg_quality_method = None
+        # detach the (already unmapped) buffers so replaying set_format
+        # doesn't release them. They are attached again even if replaying
+        # fails so the next attempt remaps them
+        buffers, self.device._buffers = self.device._buffers, None
+        try:
+            for method, args in list(self._settings.values()):
+                method(*args)
+        finally:
+            self.device._buffers = buffers
+        if buffers is not None:
+            buffers.reallocate()
+        if self.streaming:
+            self.start()
+
     @property
     def formats(self):
         return [fmt for fmt in self.device.info.formats if fmt.type == self.buffer_type]
@@ -236,22 +527,142 @@ class VideoCapture:
             if crop.type == self.buffer_type
         ]
 
+    @property
+    def selection_supported(self):
+        """True if the driver implements the selection API (G/S_SELECTION)"""
+        if self._selection_supported is None:
+            try:
+                self.get_selection(SelectionTarget.CROP_BOUNDS)
+                self._selection_supported = True
+            except OSError as error:
+                if error.errno not in (errno.EINVAL, errno.ENOTTY, errno.ENODATA):
+                    raise
+                self._selection_supported = False
+        return self._selection_supported
+
+    def get_selection(self, target=SelectionTarget.CROP):
+        s = raw.v4l2_selection()
+        s.type = self.buffer_type
+        s.target = target
+        self._ioctl(IOC.G_SELECTION, s)
+        return Rect(s.r.left, s.r.top, s.r.width, s.r.height)
+
+    def set_selection(self, left, top, width, height,
+                      target=SelectionTarget.CROP, flags=0):
+        s = raw.v4l2_selection()
+        s.type = self.buffer_type
+        s.target = target
+        s.flags = flags
+        s.r.left = left
+        s.r.top = top
+        s.r.width = width
+        s.r.height = height
+        self._ioctl(IOC.S_SELECTION, s)
+        self._remember(("selection", target), self.set_selection,
+                       left, top, width, height, target, flags)
+        # the driver may have adjusted the rectangle to what the hardware supports
+        return Rect(s.r.left, s.r.top, s.r.width, s.r.height)
+
+    def get_crop(self):
+        if self.selection_supported:
+            return self.get_selection(SelectionTarget.CROP)
+        f = raw.v4l2_crop()
+        f.type = self.buffer_type
+        self._ioctl(IOC.G_CROP, f)
+        return Rect(f.c.left, f.c.top, f.c.width, f.c.height)
+
     def set_crop(self, left, top, width, height):
-        c = raw.v4l2_rect()
-        c.left = left
-        c.top = top
-        c.width = width
-        c.height = height
+        if self.selection_supported:
+            return self.set_selection(left, top, width, height)
         f = raw.v4l2_crop()
         f.type = self.buffer_type
-        f.c = self.crop_capabilities[0].defrect
-        return self._ioctl(IOC.S_CROP, f)
+        f.c.left = left
+        f.c.top = top
+        f.c.width = width
+        f.c.height = height
+        self._ioctl(IOC.S_CROP, f)
+        self._remember("crop", self.set_crop, left, top, width, height)
+        return self.get_crop()
+
+    def reset_crop(self):
+        if self.selection_supported:
+            rect = self.get_selection(SelectionTarget.CROP_DEFAULT)
+        else:
+            rect = self.crop_capabilities[0].defrect
+        return self.set_crop(*rect)
+
+    def query_ctrl(self, id):
+        q = raw.v4l2_queryctrl()
+        q.id = id
+        self._ioctl(IOC.QUERYCTRL, q)
+        return Control(
+            id=q.id, type=q.type, name=q.name.decode(),
+            minimum=q.minimum, maximum=q.maximum, step=q.step,
+            default=q.default_value, flags=CtrlFlag(q.flags))
+
+    def get_ctrl(self, id):
+        f = raw.v4l2_control()
+        f.id = id
+        self._ioctl(IOC.G_CTRL, f)
+        return f.value
 
     def set_ctrl(self, id, value):
         f = raw.v4l2_control()
         f.id = id
         f.value = value
-        return self._ioctl(IOC.S_CTRL, f)
+        result = self._ioctl(IOC.S_CTRL, f)
+        self._remember(("ctrl", id), self.set_ctrl, id, value)
+        return result
+
+    @property
+    def jpeg_quality_method(self):
+        """How JPEG quality can be changed on this device: "control" for
+        V4L2_CID_JPEG_COMPRESSION_QUALITY, "legacy" for VIDIOC_S_JPEGCOMP or
+        None if it can't"""
+        if self._jpeg_quality_method is None:
+            self._jpeg_quality_method = ""
+            try:
+                ctrl = self.query_ctrl(raw.V4L2_CID_JPEG_COMPRESSION_QUALITY)
+                if not ctrl.flags & (CtrlFlag.DISABLED | CtrlFlag.READ_ONLY):
+                    self._jpeg_quality_method = "control"
+            except OSError as error:
+                if error.errno not in (errno.EINVAL, errno.ENOTTY):
+                    raise
+            if not self._jpeg_quality_method:
+                try:
+                    self._ioctl(IOC.G_JPEGCOMP, raw.v4l2_jpegcompression())
+                    self._jpeg_quality_method = "legacy"
+                except OSError as error:
+                    if error.errno not in (errno.EINVAL, errno.ENOTTY):
+                        raise
+        return self._jpeg_quality_method or None
+
+    def get_jpeg_quality(self):
+        method = self.jpeg_quality_method
+        if method == "control":
+            return self.get_ctrl(raw.V4L2_CID_JPEG_COMPRESSION_QUALITY)
+        elif method == "legacy":
+            j = raw.v4l2_jpegcompression()
+            self._ioctl(IOC.G_JPEGCOMP, j)
+            return j.quality
+        raise OSError(errno.ENOTTY, "JPEG quality control not supported")
+
+    def set_jpeg_quality(self, quality):
+        method = self.jpeg_quality_method
+        if method == "control":
+            ctrl = self.query_ctrl(raw.V4L2_CID_JPEG_COMPRESSION_QUALITY)
+            quality = min(max(quality, ctrl.minimum), ctrl.maximum)
+            self.set_ctrl(ctrl.id, quality)
+        elif method == "legacy":
+            # keep the markers and APP/COM data the driver is using
+            j = raw.v4l2_jpegcompression()
+            self._ioctl(IOC.G_JPEGCOMP, j)
+            j.quality = quality
+            self._ioctl(IOC.S_JPEGCOMP, j)
+            self._remember("jpeg_quality", self.set_jpeg_quality, quality)
+        else:
+            raise OSError(errno.ENOTTY, "JPEG quality control not supported")
+        return quality
     
     def set_exposure(self, value):
         self.set_ctrl(raw.V4L2_CID_EXPOSURE_AUTO, raw.V4L2_EXPOSURE_MANUAL)
@@ -260,7 +671,7 @@ class VideoCapture:
     def set_contrast(self, value):
         self.set_ctrl(raw.V4L2_CID_CONTRAST, value)
 
-    def set_format(self, width, height, pixel_format="MJPG"):
+    def _v4l2_format(self, width, height, pixel_format):
         f = raw.v4l2_format()
         if isinstance(pixel_format, str):
             pixel_format = raw.v4l2_fourcc(*pixel_format.upper())
@@ -270,24 +681,54 @@ class VideoCapture:
         f.fmt.pix.width = width
         f.fmt.pix.height = height
         f.fmt.pix.bytesperline = 0
-        return self._ioctl(IOC.S_FMT, f)
+        return f
+
+    def set_format(self, width, height, pixel_format="MJPG", keep_buffers=False):
+        """Set the capture format. Mapped buffers are released first unless
+        keep_buffers is set, in which case it is up to the driver to accept
+        the new format with buffers allocated (most return EBUSY)"""
+        f = self._v4l2_format(width, height, pixel_format)
+        pixel_format = f.fmt.pix.pixelformat
+        buffers = self.device._buffers
+        if buffers is not None:
+            if self.get_format()[:3] == (width, height, pixel_format):
+                # nothing changes: keep the buffers we have mapped
+                self._remember("format", self.set_format, width, height, pixel_format)
+                return 0
+            if not keep_buffers:
+                # the driver refuses S_FMT while buffers are allocated
+                self.release_buffers()
+                buffers = None
+        result = self._ioctl(IOC.S_FMT, f)
+        self._remember("format", self.set_format, width, height, pixel_format)
+        if buffers is not None:
+            buffers.format = self.get_format()
+        return result
 
-    def get_format(self):
-        f = raw.v4l2_format()
-        f.type = self.buffer_type
-        self._ioctl(IOC.G_FMT, f)
+    def try_format(self, width, height, pixel_format="MJPG"):
+        """The format the driver would pick for the given one, without
+        changing anything"""
+        f = self._v4l2_format(width, height, pixel_format)
+        self._ioctl(IOC.TRY_FMT, f)
         return Format(
             width=f.fmt.pix.width,
             height=f.fmt.pix.height,
-            pixel_format=PixelFormat(f.fmt.pix.pixelformat)
+            pixel_format=PixelFormat(f.fmt.pix.pixelformat),
+            bytesperline=f.fmt.pix.bytesperline,
+            size=f.fmt.pix.sizeimage,
         )
 
+    def get_format(self):
+        return get_format(self.device, self.buffer_type)
+
     def set_fps(self, fps):
         p = raw.v4l2_streamparm()
         p.type = self.buffer_type
         p.parm.capture.timeperframe.numerator = 1
         p.parm.capture.timeperframe.denominator = fps
-        return self._ioctl(IOC.S_PARM, p)
+        result = self._ioctl(IOC.S_PARM, p)
+        self._remember("fps", self.set_fps, fps)
+        return result
 
     def get_fps(self):
         p = raw.v4l2_streamparm()
@@ -295,13 +736,123 @@ class VideoCapture:
         self._ioctl(IOC.G_PARM, p)
         return p.parm.capture.timeperframe.denominator
 
+    def get_buffers(self, buffer_size=1, buffer_queue=True, memory=Memory.MMAP):
+        """Return the mapped buffers, reusing the current ones if they fit"""
+        buffers = self.device._buffers
+        if buffers is not None:
+            if buffers.matches(self.buffer_type, buffer_size, buffer_queue, memory):
+                return buffers
+            self.release_buffers()
+        return Buffers(self.device, self.buffer_type, buffer_size, buffer_queue, memory)
+
+    def release_buffers(self):
+        if self.streaming:
+            self.stop()
+        if self.device._buffers is not None:
+            self.device._buffers.close()
+
     def start(self):
+        buffers = self.device._buffers
+        if buffers is not None and buffers.buffer_queue:
+            buffers.enqueue()
         btype = raw.v4l2_buf_type(self.buffer_type)
         self._ioctl(IOC.STREAMON, btype)
+        self.streaming = True
 
     def stop(self):
-        btype = raw.v4l2_buf_type(self.buffer_type)
-        self._ioctl(IOC.STREAMOFF, btype)
+        self.streaming = False
+        if not self.device.closed:
+            # a closed (lost) device isn't streaming anymore
+            btype = raw.v4l2_buf_type(self.buffer_type)
+            self._ioctl(IOC.STREAMOFF, btype)
+        if self.device._buffers is not None:
+            self.device._buffers.dequeued()
+
+
+class Frame(bytes):
+    """The bytes of a captured frame plus the metadata of the buffer and the
+    format it was captured with.
+
+    Times are in seconds. `timestamp` is the driver timestamp, `dequeued`
+    the time.monotonic() at which we got the buffer back from the driver"""
+
+    def __new__(cls, data, buff=None, format=None):
+        frame = super().__new__(cls, data)
+        frame.dequeued = time.monotonic()
+        # to map monotonic times to wall clock time
+        frame._wall_offset = time.time() - frame.dequeued
+        frame.format = format
+        if buff is None:
+            frame.index = frame.sequence = frame.timestamp = None
+            frame.flags = 0
+        else:
+            frame.index = buff.index
+            frame.sequence = buff.sequence
+            frame.flags = buff.flags
+            frame.timestamp = buff.timestamp.secs + buff.timestamp.usecs * 1e-6
+        return frame
+
+    @property
+    def monotonic(self):
+        """Capture time on the time.monotonic() clock or None if the driver
+        timestamps don't come from the monotonic clock"""
+        ts_type = self.flags & raw.V4L2_BUF_FLAG_TIMESTAMP_MASK
+        if ts_type == raw.V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC:
+            return self.timestamp
+
+    @property
+    def wall_time(self):
+        """Capture time as a time.time() value (dequeue time if the capture
+        time is not known)"""
+        monotonic = self.monotonic
+        if monotonic is None:
+            monotonic = self.dequeued
+        return monotonic + self._wall_offset
+
+    @property
+    def latency(self):
+        """Time between the driver timestamp and DQBUF, None if unknown"""
+        monotonic = self.monotonic
+        if monotonic is not None:
+            return self.dequeued - monotonic
+
+    @property
+    def start_of_exposure(self):
+        """True if the timestamp is taken at the start of exposure rather than
+        at the end of the frame"""
+        src = self.flags & raw.V4L2_BUF_FLAG_TSTAMP_SRC_MASK
+        return src == raw.V4L2_BUF_FLAG_TSTAMP_SRC_SOE
+
+    def as_array(self):
+        """A numpy view (no copy) over the pixels, laid out according to the
+        frame format:
+
+        * GREY: (height, width)
+        * YUYV: (height, width, 2): Y in [..., 0], U/V alternating in [..., 1]
+        * NV12: (height * 3 // 2, width): the Y plane followed by the
+          interleaved UV plane
+        """
+        import numpy
+        fmt = self.format
+        width, height, stride = fmt.width, fmt.height, fmt.bytesperline
+        if fmt.pixel_format == PixelFormat.GREY:
+            shape, strides = (height, width), (stride, 1)
+        elif fmt.pixel_format == PixelFormat.YUYV:
+            shape, strides = (height, width, 2), (stride, 2, 1)
+        elif fmt.pixel_format == PixelFormat.NV12:
+            shape, strides = (height * 3 // 2, width), (stride, 1)
+        else:
+            raise ValueError(f"No array view for {fmt.pixel_format.name} frames")
+        return numpy.ndarray(shape, numpy.uint8, buffer=self, strides=strides)
+
+    def luma(self):
+        """A numpy view (no copy) of the Y plane: (height, width)"""
+        array = self.as_array()
+        if self.format.pixel_format == PixelFormat.YUYV:
+            return array[..., 0]
+        elif self.format.pixel_format == PixelFormat.NV12:
+            return array[:self.format.height]
+        return array
 
 
 class BaseBuffer:
@@ -343,8 +894,8 @@ class BufferMMAP(BaseBuffer):
         self._ioctl(IOC.QUERYBUF, buff)
         self.mmap = mmap.mmap(self.device.fileno(), buff.length, offset=buff.m.offset)
         self.length = buff.length
-        if self.queue:
-            self._ioctl(IOC.QBUF, buff)
+        # buffers are handed to the driver by enqueue() when streaming starts
+        self.queued = False
 
     def _v4l2_buffer(self):
         buff = super()._v4l2_buffer()
@@ -356,15 +907,23 @@ class BufferMMAP(BaseBuffer):
             self.mmap.close()
             self.mmap = None
 
-    def raw_read(self, buff):
-        result = self.mmap[:buff.bytesused]
+    def enqueue(self, buff=None):
+        if buff is None:
+            buff = self._v4l2_buffer()
+        self._ioctl(IOC.QBUF, buff)
+        self.queued = True
+
+    def raw_read(self, buff, format=None):
+        self.queued = False
+        with memoryview(self.mmap) as view, view[:buff.bytesused] as data:
+            result = Frame(data, buff, format)
         if self.queue:
-            self._ioctl(IOC.QBUF, buff)
+            self.enqueue(buff)
         return result
 
-    def read(self, buff):
+    def read(self, buff, format=None):
         select.select((self.device,), (), ())
-        return self.raw_read(buff)
+        return self.raw_read(buff, format)
 
 
 class Buffers:
@@ -378,6 +937,9 @@ class Buffers:
         self.buffer_queue = buffer_queue
         self.memory = memory
         self.buffers = self._create_buffers()
+        self.format = get_format(device, buffer_type)
+        # let the device remap us if it has to be reopened
+        device._buffers = self
 
     def __enter__(self):
         self._context_level += 1
@@ -391,46 +953,103 @@ class Buffers:
     def _ioctl(self, request, arg=0):
         return self.device._ioctl(request.value, arg=arg)
 
-    def _create_buffers(self):
-        if self.memory != Memory.MMAP:
-            raise TypeError(f"Unsupported buffer type {self.memory.name!r}")
+    def _request_buffers(self, count):
         r = raw.v4l2_requestbuffers()
-        r.count = self.buffer_size
+        r.count = count
         r.type = self.buffer_type
         r.memory = self.memory
         self._ioctl(IOC.REQBUFS, r)
-        if not r.count:
+        return r.count
+
+    def _create_buffers(self):
+        if self.memory != Memory.MMAP:
+            raise TypeError(f"Unsupported buffer type {self.memory.name!r}")
+        count = self._request_buffers(self.buffer_size)
+        if not count:
             raise IOError("Not enough buffer memory")
         return [
             BufferMMAP(self.device, index, self.buffer_type, self.buffer_queue)
-            for index in range(r.count)
+            for index in range(count)
         ]
 
-    def close(self):
+    def matches(self, buffer_type, buffer_size, buffer_queue, memory):
+        """True if these buffers can serve a stream with the given parameters"""
+        return (
+            self.buffers is not None and
+            (self.buffer_type, self.buffer_size, self.buffer_queue, self.memory) ==
+            (buffer_type, buffer_size, buffer_queue, memory)
+        )
+
+    def enqueue(self):
+        """Hand all the buffers we are not holding to the driver"""
+        for buff in self.buffers:
+            if not buff.queued:
+                buff.enqueue()
+
+    def dequeued(self):
+        """Called after STREAMOFF which returns all buffers to user space"""
+        for buff in self.buffers or ():
+            buff.queued = False
+
+    def unmap(self):
         if self.buffers:
             for buff in self.buffers:
                 buff.close()
-            self.buffers = None
+            self.buffers = []
+
+    def reallocate(self):
+        self.unmap()
+        self.buffers = self._create_buffers()
+        self.format = get_format(self.device, self.buffer_type)
+
+    def close(self):
+        if self.buffers is None:
+            return
+        self.unmap()
+        self.buffers = None
+        if self.device._buffers is self:
+            self.device._buffers = None
+        if not self.device.closed:
+            # free the driver side memory so the format can be changed
+            self._request_buffers(0)
 
     def raw_read(self):
         buff = self.buffers[0]._v4l2_buffer()
         self._ioctl(IOC.DQBUF, buff)
-        return self.buffers[buff.index].raw_read(buff)
+        return self.buffers[buff.index].raw_read(buff, self.format)
 
     def read(self):
-        select.select((self.device,), (), ())
-        return self.raw_read()
+        device = self.device
+        while True:
+            # events (POLLPRI) are only waited for if there are subscriptions
+            events = (device,) if device.subscribed else ()
+            readable, _, exceptional = select.select((device,), (), events)
+            if exceptional:
+                device.dispatch_events()
+            if not readable:
+                continue
+            try:
+                return self.raw_read()
+            except BlockingIOError:
+                # the device was reopened while we were waiting: wait again
+                continue
 
 
 class VideoStream:
 
     def __init__(self, video_capture, buffer_size=1, buffer_queue=True,
-                 memory=Memory.MMAP):
+                 memory=Memory.MMAP, validate=True, max_dropped=32):
         self._context_level = 0
         self.video_capture = video_capture
-        self.buffers = Buffers(
-            video_capture.device, video_capture.buffer_type,
-            buffer_size, buffer_queue, memory)
+        # the mapped buffers outlive the stream: they are reused by the
+        # next stream as long as the format doesn't change
+        self.buffers = video_capture.get_buffers(buffer_size, buffer_queue, memory)
+        # drop frames flagged by the driver and truncated MJPEG frames
+        self.validate = validate
+        # read() gives up after this many consecutive dropped frames
+        self.max_dropped = max_dropped
+        # frames: delivered, errors: flagged by the driver, corrupt: bad JPEG
+        self.stats = collections.Counter()
 
     def __enter__(self):
         self._context_level += 1
@@ -449,13 +1068,133 @@ class VideoStream:
             yield frame
 
     def close(self):
-        self.buffers.close()
+        if self.video_capture.streaming:
+            self.video_capture.stop()
+
+    def _accept(self, frame):
+        if not self.validate:
+            self.stats["frames"] += 1
+            return True
+        if frame.flags & raw.V4L2_BUF_FLAG_ERROR:
+            self.stats["errors"] += 1
+            return False
+        fmt = frame.format
+        if fmt is not None and fmt.pixel_format in JPEG_FORMATS:
+            if not jpeg.is_valid(frame):
+                self.stats["corrupt"] += 1
+                log.debug("dropped corrupt frame %s", frame.sequence)
+                return False
+        self.stats["frames"] += 1
+        return True
 
     def raw_read(self):
-        return self.buffers.raw_read()
+        """Read the next frame or None if it was dropped"""
+        frame = self.buffers.raw_read()
+        return frame if self._accept(frame) else None
 
     def read(self):
-        return self.buffers.read()
+        """Read the next valid frame. Raises OSError(EIO) after max_dropped
+        consecutive frames were dropped"""
+        for _ in range(self.max_dropped + 1):
+            frame = self.buffers.read()
+            if self._accept(frame):
+                return frame
+        raise OSError(
+            errno.EIO, f"{self.max_dropped + 1} consecutive frames dropped")
+
+
+class ModeSwitcher:
+    """Switch a VideoCapture between preconfigured modes, typically a low
+    resolution one to meter with and a full resolution one for stills.
+
+    Buffers are allocated for the largest mode up front and kept mapped across
+    switches when the driver accepts S_FMT with buffers allocated. Otherwise
+    they are reallocated on every switch. The time each switch takes (up to the
+    first frame after the mode's warm-up frames) is recorded so callers can
+    decide whether switching pays off."""
+
+    def __init__(self, video_capture, modes, buffer_size=1, history=32):
+        self.video_capture = video_capture
+        self.modes = dict(modes)
+        self.buffer_size = buffer_size
+        self.current = None
+        self.stream = None
+        # None until we know if the driver lets us keep the buffers
+        self.keeps_buffers = None
+        self._latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=history))
+
+    def prepare(self):
+        """Allocate buffers big enough for every mode"""
+        cap = self.video_capture
+        sizes = {
+            name: cap.try_format(mode.width, mode.height, mode.pixel_format).size
+            for name, mode in self.modes.items()
+        }
+        largest = self.modes[max(sizes, key=sizes.get)]
+        if self.stream is not None:
+            self.stream.close()
+        cap.set_format(largest.width, largest.height, largest.pixel_format)
+        cap.get_buffers(self.buffer_size)
+        self.current = None
+
+    def _apply(self, mode):
+        cap = self.video_capture
+        buffers = cap.device._buffers
+        if buffers is not None and self.keeps_buffers is not False:
+            try:
+                cap.set_format(mode.width, mode.height, mode.pixel_format,
+                               keep_buffers=True)
+            except OSError as error:
+                if error.errno != errno.EBUSY:
+                    raise
+                self.keeps_buffers = False
+            else:
+                if all(buff.length >= buffers.format.size for buff in buffers.buffers):
+                    self.keeps_buffers = True
+                    return
+                # mapped buffers too small for this mode
+                cap.release_buffers()
+        cap.set_format(mode.width, mode.height, mode.pixel_format)
+
+    def switch(self, name):
+        """Switch to the named mode and return a frame iterator for it"""
+        if name == self.current:
+            return self.stream
+        mode = self.modes[name]
+        start = time.monotonic()
+        if self.stream is not None:
+            self.stream.close()
+        self._apply(mode)
+        if mode.fps:
+            self.video_capture.set_fps(mode.fps)
+        self.stream = iter(VideoStream(self.video_capture, self.buffer_size))
+        for _ in range(mode.skip):
+            next(self.stream)
+        self.current = name
+        self._latencies[name].append(time.monotonic() - start)
+        return self.stream
+
+    def restart(self):
+        """A new frame iterator in the current mode, after the last one
+        failed (eg. the device was lost)"""
+        name, self.current = self.current, None
+        return self.switch(name)
+
+    def latency(self, name):
+        """Mean time it took to switch to the named mode, None if unknown"""
+        latencies = self._latencies.get(name)
+        return sum(latencies) / len(latencies) if latencies else None
+
+    def stats(self):
+        return {
+            name: {
+                "switches": len(latencies),
+                "mean": sum(latencies) / len(latencies),
+                "last": latencies[-1],
+            }
+            for name, latencies in self._latencies.items() if latencies
+        }
 
 
 def Stream(stream):
@@ -471,6 +1210,7 @@ async def AsyncStream(stream):
     import asyncio
     cap = stream.video_capture
     fd = cap.device.fileno()
+    generation = cap.device.generation
     loop = asyncio.get_event_loop()
     event = asyncio.Event()
     loop.add_reader(fd, event.set)
@@ -479,17 +1219,30 @@ async def AsyncStream(stream):
         while True:
             await event.wait()
             event.clear()
-            yield stream.raw_read()
+            try:
+                frame = stream.raw_read()
+            except BlockingIOError:
+                frame = None
+            if cap.device.generation != generation:
+                # the device was reopened: watch the new file descriptor
+                loop.remove_reader(fd)
+                fd = cap.device.fileno()
+                generation = cap.device.generation
+                loop.add_reader(fd, event.set)
+            if frame is not None:
+                yield frame
     finally:
         cap.stop()
         loop.remove_reader(fd)
 
-def iter_devices(path="/dev"):
-    path = pathlib.Path(path)
-    files = path.glob("video*")
-    return (Device(name) for name in files)
+def iter_devices(path="/dev", workers=None):
+    return (Device(node.filename) for node in iter_nodes(path, workers))
 
 
-def iter_video_capture_devices(path="/dev"):
-    f = lambda d: Capability.VIDEO_CAPTURE in d.info.capabilities
-    return filter(f, iter_devices(path))
+def iter_video_capture_devices(path="/dev", workers=None):
+    # filter on the QUERYCAP result so only the matching nodes are opened
+    nodes = iter_nodes(path, workers)
+    return (
+        Device(node.filename) for node in nodes
+        if Capability.VIDEO_CAPTURE in node.capabilities
+    )
@@ -0,0 +1,275 @@
+#
+# This file is part of the v4l2py project
+#
+# Copyright (c) 2021 Tiago Coutinho
+# Distributed under the GPLv3 license. See LICENSE for more info.
+
+"""Cheap structural checks and header parsing of (M)JPEG frames"""
+
+import struct
+import ctypes
+import ctypes.util
+import collections
+
+SOI = b"\xff\xd8"
+EOI = b"\xff\xd9"
+SOS = 0xDA
+DRI = 0xDD
+APP0 = 0xE0
+APP1 = 0xE1
+EXIF = b"Exif\0\0"
+# EXIF (TIFF) tags and types
+TAG_IMAGE_DESCRIPTION = 0x010E
+TAG_SOFTWARE = 0x0131
+TAG_DATE_TIME = 0x0132
+TYPE_ASCII = 2
+TEM = 0x01
+RST = range(0xD0, 0xD8)
+# SOF0-SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# SOI + a minimal SOF + SOS + EOI
+MIN_SIZE = 2 + 13 + 12 + 2
+# some cameras pad frames with zeros after EOI: the padding is skipped this
+# many bytes at a time, from the end of the frame
+TAIL_SIZE = 1024
+
+
+# tjTransform() operations and options (turbojpeg.h)
+TJXOP_NONE = 0
+TJXOPT_PERFECT = 1
+TJXOPT_TRIM = 2
+TJXOPT_CROP = 4
+
+
+class JpegError(ValueError):
+    pass
+
+
+class tjregion(ctypes.Structure):
+    _fields_ = [
+        ("x", ctypes.c_int),
+        ("y", ctypes.c_int),
+        ("w", ctypes.c_int),
+        ("h", ctypes.c_int),
+    ]
+
+
+class tjtransform(ctypes.Structure):
+    _fields_ = [
+        ("r", tjregion),
+        ("op", ctypes.c_int),
+        ("options", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("customFilter", ctypes.c_void_p),
+    ]
+
+
+Component = collections.namedtuple("Component", "id h v table")
+
+Header = collections.namedtuple(
+    "Header", "width height marker components mcu_width mcu_height restart_interval")
+
+
+def segments(data):
+    """Iterate over the (marker, offset, length) of the segments of data up to
+    and including SOS. offset is that of the marker and length is the
+    segment length (0 for markers without one). Raises JpegError if they
+    are corrupt or truncated"""
+    size = len(data)
+    if data[:2] != SOI:
+        raise JpegError("missing SOI")
+    pos = 2
+    while True:
+        if pos + 2 > size or data[pos] != 0xFF:
+            raise JpegError(f"no marker at {pos}")
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker == TEM or marker in RST:
+            yield marker, pos, 0
+            pos += 2
+            continue
+        if marker == EOI[1]:
+            raise JpegError(f"EOI before SOS at {pos}")
+        if pos + 4 > size:
+            raise JpegError(f"truncated segment at {pos}")
+        length = (data[pos + 2] << 8) | data[pos + 3]
+        if length < 2 or pos + 2 + length > size:
+            raise JpegError(f"bad segment length {length} at {pos}")
+        yield marker, pos, length
+        if marker == SOS:
+            return
+        pos += 2 + length
+
+
+def check(data, min_size=MIN_SIZE):
+    """Check the markers and segment lengths of data up to the start of scan
+    and that the scan is terminated by EOI. Raises JpegError if the frame is
+    corrupt or truncated.
+
+    Only the headers are walked, which is O(number of markers), the entropy
+    coded data isn't looked at"""
+    size = len(data)
+    if size < min_size:
+        raise JpegError(f"truncated: {size} bytes")
+    frame_header = False
+    for marker, pos, length in segments(data):
+        if marker in SOF:
+            frame_header = True
+    if not frame_header:
+        raise JpegError("SOS without SOF")
+    pos += 2 + length
+    end = size
+    while end > pos:
+        start = max(pos, end - TAIL_SIZE)
+        kept = len(bytes(data[start:end]).rstrip(b"\0"))
+        if kept:
+            end = start + kept
+            break
+        end = start
+    if end - pos < 2 or bytes(data[end - 2:end]) != EOI:
+        raise JpegError("missing EOI")
+
+
+def parse_header(data):
+    """Geometry of a JPEG from its frame header (SOF)"""
+    restart_interval = 0
+    for marker, pos, length in segments(data):
+        if marker == DRI:
+            restart_interval = (data[pos + 4] << 8) | data[pos + 5]
+        elif marker in SOF:
+            height = (data[pos + 5] << 8) | data[pos + 6]
+            width = (data[pos + 7] << 8) | data[pos + 8]
+            components = tuple(
+                Component(
+                    id=data[i],
+                    h=data[i + 1] >> 4,
+                    v=data[i + 1] & 0x0F,
+                    table=data[i + 2],
+                )
+                for i in range(pos + 10, pos + 10 + 3 * data[pos + 9], 3)
+            )
+            if not components:
+                raise JpegError("frame without components")
+            break
+        elif marker == SOS:
+            raise JpegError("SOS without SOF")
+    return Header(
+        width=width,
+        height=height,
+        marker=marker,
+        components=components,
+        mcu_width=8 * max(c.h for c in components),
+        mcu_height=8 * max(c.v for c in components),
+        restart_interval=restart_interval,
+    )
+
+
+_turbojpeg = None
+
+
+def turbojpeg():
+    """The TurboJPEG library or None if it is not installed"""
+    global _turbojpeg
+    if _turbojpeg is None:
+        name = ctypes.util.find_library("turbojpeg") or "libturbojpeg.so.0"
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError:
+            lib = False
+        else:
+            lib.tjInitTransform.restype = ctypes.c_void_p
+            lib.tjDestroy.argtypes = [ctypes.c_void_p]
+            lib.tjFree.argtypes = [ctypes.c_void_p]
+            lib.tjGetErrorStr.restype = ctypes.c_char_p
+            lib.tjTransform.argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ulong, ctypes.c_int,
+                ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_ulong),
+                ctypes.POINTER(tjtransform), ctypes.c_int,
+            ]
+        _turbojpeg = lib
+    return _turbojpeg or None
+
+
+def crop(data, x, y, width, height):
+    """Crop a JPEG losslessly, like jpegtran -crop: the DCT coefficients of
+    the blocks in the region are copied, nothing is decoded or re-encoded.
+
+    x and y must be multiples of the MCU size (see parse_header). Raises
+    JpegError if they are not or TurboJPEG is not installed"""
+    header = parse_header(data)
+    if x % header.mcu_width or y % header.mcu_height:
+        raise JpegError(
+            f"crop offset {x},{y} not aligned to the "
+            f"{header.mcu_width}x{header.mcu_height} MCU")
+    lib = turbojpeg()
+    if lib is None:
+        raise JpegError("lossless crop needs libturbojpeg")
+    src = (ctypes.c_ubyte * len(data)).from_buffer_copy(data)
+    transform = tjtransform(
+        r=tjregion(x, y, width, height), op=TJXOP_NONE,
+        options=TJXOPT_CROP)
+    dst = ctypes.c_void_p()
+    dst_size = ctypes.c_ulong()
+    handle = lib.tjInitTransform()
+    if not handle:
+        raise JpegError(lib.tjGetErrorStr().decode())
+    try:
+        if lib.tjTransform(handle, src, len(data), 1, ctypes.byref(dst),
+                           ctypes.byref(dst_size), ctypes.byref(transform), 0):
+            raise JpegError(lib.tjGetErrorStr().decode())
+        return ctypes.string_at(dst, dst_size.value)
+    finally:
+        if dst:
+            lib.tjFree(dst)
+        lib.tjDestroy(handle)
+
+
+def insert_segment(data, marker, payload):
+    """A copy of data with an APPn segment inserted after SOI and the JFIF
+    (APP0) segments, without decoding anything"""
+    if len(payload) + 2 > 0xFFFF:
+        raise JpegError(f"segment too long: {len(payload)} bytes")
+    for pos_marker, pos, length in segments(data):
+        if pos_marker != APP0:
+            break
+    segment = struct.pack(">BBH", 0xFF, marker, len(payload) + 2)
+    return b"".join((data[:pos], segment, payload, data[pos:]))
+
+
+def exif(description, date_time=None, software=None):
+    """APP1 payload of a minimal EXIF: an IFD0 with the ImageDescription, and
+    optionally the DateTime (a datetime) and Software"""
+    entries = [(TAG_IMAGE_DESCRIPTION, description)]
+    if software is not None:
+        entries.append((TAG_SOFTWARE, software))
+    if date_time is not None:
+        entries.append((TAG_DATE_TIME, date_time.strftime("%Y:%m:%d %H:%M:%S")))
+    # little endian TIFF header, IFD0 right after it
+    ifd_offset = 8
+    values_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    ifd = [struct.pack("<H", len(entries))]
+    values = []
+    for tag, text in entries:
+        value = text.encode() + b"\0"
+        if len(value) <= 4:
+            ifd.append(struct.pack("<HHI4s", tag, TYPE_ASCII, len(value), value))
+        else:
+            ifd.append(struct.pack("<HHII", tag, TYPE_ASCII, len(value), values_offset))
+            # values start on a word boundary
+            value += b"\0" * (len(value) % 2)
+            values.append(value)
+            values_offset += len(value)
+    ifd.append(struct.pack("<I", 0))
+    return b"".join((EXIF, b"II*\0", struct.pack("<I", ifd_offset), *ifd, *values))
+
+
+def is_valid(data, min_size=MIN_SIZE):
+    try:
+        check(data, min_size)
+    except JpegError:
+        return False
+    return True
@@ -69,6 +69,13 @@ class timeval(ctypes.Structure):
     ]
 
 
+class timespec(ctypes.Structure):
+    _fields_ = [
+        ('secs', ctypes.c_long),
+        ('nsecs', ctypes.c_long),
+    ]
+
+
 #
 # v4l2
 #
@@ -615,8 +622,24 @@ V4L2_BUF_FLAG_DONE = 0x0004
 V4L2_BUF_FLAG_KEYFRAME = 0x0008
 V4L2_BUF_FLAG_PFRAME = 0x0010
 V4L2_BUF_FLAG_BFRAME = 0x0020
+V4L2_BUF_FLAG_ERROR = 0x0040
 V4L2_BUF_FLAG_TIMECODE = 0x0100
 V4L2_BUF_FLAG_INPUT = 0x0200
+V4L2_BUF_FLAG_PREPARED = 0x0400
+V4L2_BUF_FLAG_NO_CACHE_INVALIDATE = 0x0800
+V4L2_BUF_FLAG_NO_CACHE_CLEAN = 0x1000
+V4L2_BUF_FLAG_LAST = 0x00100000
+
+# Timestamp type
+V4L2_BUF_FLAG_TIMESTAMP_MASK = 0x0000e000
+V4L2_BUF_FLAG_TIMESTAMP_UNKNOWN = 0x00000000
+V4L2_BUF_FLAG_TIMESTAMP_MONOTONIC = 0x00002000
+V4L2_BUF_FLAG_TIMESTAMP_COPY = 0x00004000
+
+# Timestamp sources
+V4L2_BUF_FLAG_TSTAMP_SRC_MASK = 0x00070000
+V4L2_BUF_FLAG_TSTAMP_SRC_EOF = 0x00000000
+V4L2_BUF_FLAG_TSTAMP_SRC_SOE = 0x00010000
 
 
 #
@@ -719,6 +742,36 @@ class v4l2_crop(ctypes.Structure):
     ]
 
 
+#
+# Selection API
+#
+
+class v4l2_selection(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('target', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('r', v4l2_rect),
+        ('reserved', ctypes.c_uint32 * 9),
+    ]
+
+
+# Selection targets
+V4L2_SEL_TGT_CROP = 0x0000  # Current cropping area
+V4L2_SEL_TGT_CROP_DEFAULT = 0x0001  # Default cropping area
+V4L2_SEL_TGT_CROP_BOUNDS = 0x0002  # Cropping bounds
+V4L2_SEL_TGT_NATIVE_SIZE = 0x0003  # Native frame size
+V4L2_SEL_TGT_COMPOSE = 0x0100  # Current composing area
+V4L2_SEL_TGT_COMPOSE_DEFAULT = 0x0101  # Default composing area
+V4L2_SEL_TGT_COMPOSE_BOUNDS = 0x0102  # Composing bounds
+V4L2_SEL_TGT_COMPOSE_PADDED = 0x0103  # Current composing area plus all padding pixels
+
+# Selection flags
+V4L2_SEL_FLAG_GE = 1 << 0
+V4L2_SEL_FLAG_LE = 1 << 1
+V4L2_SEL_FLAG_KEEP_CONFIG = 1 << 2
+
+
 #
 # Analog video standard
 #
@@ -1488,6 +1541,33 @@ V4L2_CID_TEST_PATTERN		= V4L2_CID_IMAGE_PROC_CLASS_BASE + 3
 V4L2_CID_DEINTERLACING_MODE	= V4L2_CID_IMAGE_PROC_CLASS_BASE + 4
 V4L2_CID_DIGITAL_GAIN		= V4L2_CID_IMAGE_PROC_CLASS_BASE + 5
 
+# JPEG-compression controls
+
+V4L2_CID_JPEG_CLASS_BASE	= V4L2_CTRL_CLASS_JPEG | 0x900
+V4L2_CID_JPEG_CLASS		= V4L2_CTRL_CLASS_JPEG | 1
+
+V4L2_CID_JPEG_CHROMA_SUBSAMPLING	= V4L2_CID_JPEG_CLASS_BASE + 1
+
+v4l2_jpeg_chroma_subsampling = enum
+(
+    V4L2_JPEG_CHROMA_SUBSAMPLING_444,
+    V4L2_JPEG_CHROMA_SUBSAMPLING_422,
+    V4L2_JPEG_CHROMA_SUBSAMPLING_420,
+    V4L2_JPEG_CHROMA_SUBSAMPLING_411,
+    V4L2_JPEG_CHROMA_SUBSAMPLING_410,
+    V4L2_JPEG_CHROMA_SUBSAMPLING_GRAY,
+) = range(6)
+
+V4L2_CID_JPEG_RESTART_INTERVAL	= V4L2_CID_JPEG_CLASS_BASE + 2
+V4L2_CID_JPEG_COMPRESSION_QUALITY	= V4L2_CID_JPEG_CLASS_BASE + 3
+V4L2_CID_JPEG_ACTIVE_MARKER	= V4L2_CID_JPEG_CLASS_BASE + 4
+
+V4L2_JPEG_ACTIVE_MARKER_APP0 = 1 << 0
+V4L2_JPEG_ACTIVE_MARKER_APP1 = 1 << 1
+V4L2_JPEG_ACTIVE_MARKER_COM = 1 << 16
+V4L2_JPEG_ACTIVE_MARKER_DQT = 1 << 17
+V4L2_JPEG_ACTIVE_MARKER_DHT = 1 << 18
+
 
 #
 # Tuning
@@ -1875,6 +1955,116 @@ class v4l2_dbg_chip_ident(ctypes.Structure):
     _pack_ = True
 
 
+#
+# Events
+#
+
+V4L2_EVENT_ALL = 0
+V4L2_EVENT_VSYNC = 1
+V4L2_EVENT_EOS = 2
+V4L2_EVENT_CTRL = 3
+V4L2_EVENT_FRAME_SYNC = 4
+V4L2_EVENT_SOURCE_CHANGE = 5
+V4L2_EVENT_MOTION_DET = 6
+V4L2_EVENT_PRIVATE_START = 0x08000000
+
+
+class v4l2_event_vsync(ctypes.Structure):
+    _fields_ = [
+        ('field', ctypes.c_uint8),
+    ]
+
+    _pack_ = True
+
+
+# Payload for V4L2_EVENT_CTRL
+V4L2_EVENT_CTRL_CH_VALUE = 1 << 0
+V4L2_EVENT_CTRL_CH_FLAGS = 1 << 1
+V4L2_EVENT_CTRL_CH_RANGE = 1 << 2
+
+
+class v4l2_event_ctrl(ctypes.Structure):
+    class _u(ctypes.Union):
+        _fields_ = [
+            ('value', ctypes.c_int32),
+            ('value64', ctypes.c_int64),
+        ]
+
+    _fields_ = [
+        ('changes', ctypes.c_uint32),
+        ('type', ctypes.c_uint32),
+        ('_u', _u),
+        ('flags', ctypes.c_uint32),
+        ('minimum', ctypes.c_int32),
+        ('maximum', ctypes.c_int32),
+        ('step', ctypes.c_int32),
+        ('default_value', ctypes.c_int32),
+    ]
+
+    _anonymous_ = ('_u',)
+
+
+class v4l2_event_frame_sync(ctypes.Structure):
+    _fields_ = [
+        ('frame_sequence', ctypes.c_uint32),
+    ]
+
+
+V4L2_EVENT_SRC_CH_RESOLUTION = 1 << 0
+
+
+class v4l2_event_src_change(ctypes.Structure):
+    _fields_ = [
+        ('changes', ctypes.c_uint32),
+    ]
+
+
+V4L2_EVENT_MD_FL_HAVE_FRAME_SEQ = 1 << 0
+
+
+class v4l2_event_motion_det(ctypes.Structure):
+    _fields_ = [
+        ('flags', ctypes.c_uint32),
+        ('frame_sequence', ctypes.c_uint32),
+        ('region_mask', ctypes.c_uint32),
+    ]
+
+
+class v4l2_event(ctypes.Structure):
+    class _u(ctypes.Union):
+        _fields_ = [
+            ('vsync', v4l2_event_vsync),
+            ('ctrl', v4l2_event_ctrl),
+            ('frame_sync', v4l2_event_frame_sync),
+            ('src_change', v4l2_event_src_change),
+            ('motion_det', v4l2_event_motion_det),
+            ('data', ctypes.c_uint8 * 64),
+        ]
+
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('u', _u),
+        ('pending', ctypes.c_uint32),
+        ('sequence', ctypes.c_uint32),
+        ('timestamp', timespec),
+        ('id', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 8),
+    ]
+
+
+V4L2_EVENT_SUB_FL_SEND_INITIAL = 1 << 0
+V4L2_EVENT_SUB_FL_ALLOW_FEEDBACK = 1 << 1
+
+
+class v4l2_event_subscription(ctypes.Structure):
+    _fields_ = [
+        ('type', ctypes.c_uint32),
+        ('id', ctypes.c_uint32),
+        ('flags', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32 * 5),
+    ]
+
+
 #
 # ioctl codes for video devices
 #
@@ -1953,6 +2143,12 @@ VIDIOC_G_DV_PRESET = _IOWR('V', 85, v4l2_dv_preset)
 VIDIOC_QUERY_DV_PRESET = _IOR('V', 86, v4l2_dv_preset)
 VIDIOC_S_DV_TIMINGS = _IOWR('V', 87, v4l2_dv_timings)
 VIDIOC_G_DV_TIMINGS = _IOWR('V', 88, v4l2_dv_timings)
+VIDIOC_DQEVENT = _IOR('V', 89, v4l2_event)
+VIDIOC_SUBSCRIBE_EVENT = _IOW('V', 90, v4l2_event_subscription)
+VIDIOC_UNSUBSCRIBE_EVENT = _IOW('V', 91, v4l2_event_subscription)
+
+VIDIOC_G_SELECTION = _IOWR('V', 94, v4l2_selection)
+VIDIOC_S_SELECTION = _IOWR('V', 95, v4l2_selection)
 
 VIDIOC_OVERLAY_OLD = _IOWR('V', 14, ctypes.c_int)
 VIDIOC_S_PARM_OLD = _IOW('V', 22, v4l2_streamparm)
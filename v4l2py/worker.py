@@ -0,0 +1,88 @@
+#
+# This file is part of the v4l2py project
+#
+# Copyright (c) 2021 Tiago Coutinho
+# Distributed under the GPLv3 license. See LICENSE for more info.
+
+import os
+import logging
+import concurrent.futures
+
+
+log = logging.getLogger(__name__)
+
+
+def parse_cpus(text):
+    """CPU set from a list like "2,3" or "1-3" (None for an empty text)"""
+    cpus = set()
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        first, _, last = item.partition("-")
+        cpus.update(range(int(first), int(last or first) + 1))
+    return cpus or None
+
+
+class CaptureWorker:
+    """A single thread dedicated to capturing, optionally pinned to a set of
+    CPUs and running with a real-time (SCHED_FIFO) priority or a nice value.
+
+    On Linux the affinity, scheduler and nice value of pid 0 are those of the
+    calling thread so they are set from the worker thread itself and don't
+    affect the rest of the process. Settings the system doesn't allow (eg.
+    SCHED_FIFO without CAP_SYS_NICE) are logged and skipped"""
+
+    def __init__(self, cpus=None, priority=None, nice=None, name="capture"):
+        self.cpus = cpus
+        self.priority = priority
+        self.nice = nice
+        # what could actually be applied
+        self.applied = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix=name, initializer=self._setup
+        )
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _setup(self):
+        if self.cpus:
+            try:
+                os.sched_setaffinity(0, self.cpus)
+                self.applied["cpus"] = sorted(os.sched_getaffinity(0))
+            except (AttributeError, OSError, ValueError) as error:
+                log.warning("could not set capture CPU affinity: %s", error)
+        if self.priority:
+            try:
+                param = os.sched_param(self.priority)
+                os.sched_setscheduler(0, os.SCHED_FIFO, param)
+                self.applied["priority"] = self.priority
+            except (AttributeError, OSError) as error:
+                log.warning("could not set capture SCHED_FIFO priority: %s", error)
+        if self.nice:
+            try:
+                os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+                self.applied["nice"] = os.getpriority(os.PRIO_PROCESS, 0)
+            except (AttributeError, OSError) as error:
+                log.warning("could not set capture nice value: %s", error)
+
+    def start(self):
+        """Start the thread now rather than on the first submit. Returns the
+        settings that could be applied"""
+        self._executor.submit(lambda: None).result()
+        return self.applied
+
+    def submit(self, func, *args, **kwargs):
+        return self._executor.submit(func, *args, **kwargs)
+
+    def run(self, func, *args, **kwargs):
+        """Run func in the capture thread and wait for its result"""
+        return self.submit(func, *args, **kwargs).result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)